@@ -6,8 +6,8 @@
 
 import numpy as np
 import pandas as pd
-from os.path import isfile, join, exists
-from os import listdir, chdir
+from os.path import isfile, join
+from os import chdir
 from tqdm import tqdm
 
 from os.path import abspath
@@ -27,27 +27,32 @@ if module_path not in sys.path:
 nnextrap_root_relpath = ".."
 pretrained_dir = "nn-extrapolation-models/pretrained_models"
 
+import contextlib
 import constants
 import utils
 import encode as enc
-import inference as inf
-import inference_lr as inf_lr
 import design_tools as dt
 
-''' 
-Calculate enrichment for a list of variants
-Args:
-    wt_unsel: WT count in unsorted population
-    wt_sel: WT count in sorted population
-    vars_unsel: numpy array of variant counts in unsorted population
-    vars_sel: numpy array of variant counts in sorted population
-Returns:
-    numpy array containing enrichment scores for all variants
-'''
-def calc_enrich(wt_unsel, wt_sel, vars_unsel, vars_sel):
-    assert wt_unsel > 0
-    assert wt_sel > 0
-    return np.log((vars_sel+0.5)/(wt_sel+0.5)) - np.log((vars_unsel+0.5)/(wt_unsel+0.5))
+from ensemble_tools import find_model_paths, EnsembleEvaluator, ensc_ensm
+from prediction_store import save_predictions
+from encoding_tools import SequenceEncoder
+from prediction_cache import open_prediction_cache
+from serving_tools import open_inference_client
+from enrichment_tools import calc_enrich
+from instrumentation import METRICS, result_length
+
+# per-stage timings are written to gen_data/metrics at exit, set PIPELINE_METRICS=none to switch them off
+METRICS.report_at_exit(join(nnextrap_root_relpath, 'gen_data/metrics/01_extrapolation_predictions.json'))
+encode = METRICS.wrap('enc.encode', enc.encode, items=result_length)
+
+# with a running inference_server.py the models are scored there and TensorFlow is never loaded here
+client = open_inference_client(join(nnextrap_root_relpath, 'gen_data/inference.sock'))
+if client is None:
+    import inference as inf
+    import inference_lr as inf_lr
+    restore_sess = METRICS.wrap('restore_sess', inf.restore_sess)
+    run_inference = METRICS.wrap('run_inference', inf.run_inference, items=result_length)
+    run_inference_lr = METRICS.wrap('run_inference', inf_lr.run_inference_lr, items=result_length)
 
 CHARS = ["A", "C", "D", "E", "F", "G", "H", "I", "K", "L",
          "M", "N", "P", "Q", "R", "S", "T", "V", "W", "Y"]
@@ -62,16 +67,14 @@ WT_res = "VDGV" # TODO: Check that this is WT!
 df = pd.read_csv(join(nnextrap_root_relpath, 'data/elife-16965-supp1-v4.csv'))
 
 
-# get full amino acid sequnce
-sequences = []
-for var in df.Variants:
-    sequence = WT
-    for wt_res, pos, res in zip(WT_res, positions, var):
-        assert(wt_res == sequence[pos])
-        sequence = sequence[:pos] + res + sequence[pos+1:]
-        
-    sequences.append(sequence)
+# get full amino acid sequnce, variants are kept as residue indices and encoded chunk by chunk
+seq_encoder = SequenceEncoder(lambda seqs: encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=[aa for aa in WT]),
+                              AAs, len(WT))
+assert(WT_res == ''.join([WT[pos] for pos in positions]))
+variant_indices = seq_encoder.substitution_indices(WT, positions, df.Variants.tolist())
+sequences = seq_encoder.to_sequences(variant_indices)
 df['sequence'] = sequences
+chunk_size = 10000
 
 # calc enrich2 fitnesses
 wt_data = df.loc[df.Variants == WT_res]
@@ -81,60 +84,64 @@ wt_sel = wt_data['Count selected'].values[0]
 df['enrich2_fit'] = calc_enrich(wt_unsel, wt_sel, df['Count input'].to_numpy(), df['Count selected'].to_numpy())
 
 
-# encode variants
-print('Encoding variants...')
-encoded_variants = enc.encode(encoding="one_hot,aa_index", char_seqs=df.sequence.tolist(), wt_aa=[aa for aa in WT])
-
 models = ['lr', 'fcn', 'gcn', 'cnn']
 
+# cache ensemble predictions across runs and scripts, set PREDICTION_CACHE=none to disable
+cache = open_prediction_cache(join(nnextrap_root_relpath, 'gen_data/prediction_cache.sqlite'))
+
+# per-member predictions of each family, kept as (num_variants, num_members) matrices
+pred_all = {}
+
 ind_model_path = join(nnextrap_root_relpath, pretrained_dir, 'other_models/gb1_')
-print('Calculating fitnesses for LR, GCN, GCN, and CNN models...')
-for model in tqdm(models, total=len(models), ncols=100, desc="Model"):
-    # get fitnesses from individual models used in paper
-    # lr requires separate inference to remove ph parameter
-    with inf.restore_sess(ind_model_path + model) as model_sess:
+
+
+@contextlib.contextmanager
+def individual_model(model):
+    # scoring function (seqs, encoded_variants) of the individual model used in the paper
+    if client is not None:
+        yield lambda seqs, encoded_variants: client.predict('gb1_' + model, seqs)[:, 0]
+        return
+    with restore_sess(ind_model_path + model) as model_sess:
+        # lr requires separate inference to remove ph parameter
         if model == 'lr':
-            df[model+'_pred'] = inf_lr.run_inference_lr(encoded_data=encoded_variants, sess=model_sess)
+            yield lambda seqs, encoded_variants: run_inference_lr(encoded_data=encoded_variants, sess=model_sess)
         # use inf import for all other models
         else:
-            df[model+'_pred'] = inf.run_inference(encoded_data=encoded_variants, sess=model_sess)
-
-    num_models = 100
-    found_models = []
-    model_paths = []
-    for i in tqdm(range(num_models), total=num_models, ncols=100, leave=False):
-        path = join(nnextrap_root_relpath, pretrained_dir, model+'s/model_'+str(i))
-        if (exists(path)):
-            for file_name in listdir(path):
-                if '.pb' in file_name:
-                    model_name = file_name
-                    model_paths.append(path+'/'+model_name)
-                    found_models.append(i)
-    if len(model_paths) != num_models:
-        print('Could not find all models, missing models: ',
-                ','.join([str(i) for i in range(100) if i not in found_models]))
-    model_sesses = []
-    for model_path in model_paths:
-        model_sesses.append(inf.restore_sess_from_pb(model_path))
-
-    # run inferences for additional models
+            yield lambda seqs, encoded_variants: run_inference(encoded_data=encoded_variants, sess=model_sess)
+
+
+print('Calculating fitnesses for LR, GCN, GCN, and CNN models...')
+for model in tqdm(models, total=len(models), ncols=100, desc="Model"):
+    if client is not None:
+        ensemble = client.ensemble(model)
+    else:
+        ensemble = EnsembleEvaluator(find_model_paths(join(nnextrap_root_relpath, pretrained_dir, model+'s')))
+    model_pred = []
     model_pred_all = []
-    for sess in model_sesses:
-        if model == 'lr':
-            model_pred_all.append(inf_lr.run_inference_lr(encoded_data=encoded_variants, sess=sess))
-        else:
-            model_pred_all.append(inf.run_inference(encoded_data=encoded_variants, sess=sess))
-    
-    df[model+'_pred_all'] = list(zip(*model_pred_all))
+    with individual_model(model) as predict_individual:
+        for start in tqdm(range(0, len(df), chunk_size), ncols=100, leave=False, desc='Chunk'):
+            # the inference server encodes the sequences itself
+            encoded_variants = None if client is not None else seq_encoder.encode_indices(variant_indices[start:start+chunk_size])
+            # get fitnesses from individual models used in paper
+            model_pred.append(predict_individual(sequences[start:start+chunk_size], encoded_variants))
+
+            # run inferences for additional models, all members of the family are evaluated in one graph
+            model_pred_all.append(ensemble.predict_cached(sequences[start:start+chunk_size], encoded_variants, cache))
+    ensemble.close()
+
+    df[model+'_pred'] = np.concatenate(model_pred)
+    pred_all[model+'_pred_all'] = np.concatenate(model_pred_all)
+
+if cache is not None:
+    print(cache.report())
+    cache.close()
 
 
-# further process predictions to save only essential data used for processing. Must do this because full
-# output is ~1.3 GB, which is too big for GitHub.
+# further process predictions to save only essential data used for processing. The full per-member
+# predictions are saved as binary matrices below.
 
-# get fitness for EnsC and EnsM by taking 5th lowest value and median value from cnn_pred_all
-df['cnn_pred_all_sort'] = [pd.Series(ele).sort_values() for ele in df['cnn_pred_all']]
-df['ensc_pred'] = [ele.iloc[5] for ele in df['cnn_pred_all_sort']]
-df['ensm_pred'] = [ele.median() for ele in df['cnn_pred_all_sort']]
+# get fitness for EnsC and EnsM from cnn_pred_all (index 5 of the sorted predictions and median)
+df['ensc_pred'], df['ensm_pred'] = ensc_ensm(pred_all['cnn_pred_all'])
 
 # columns to save
 save_columns = [
@@ -151,5 +158,5 @@ save_columns = [
 
 # save processed data to csv
 df[save_columns].to_csv(join(nnextrap_root_relpath, 'gen_data/pred_extrapolation_wu.csv'))
-# save full data to csv
-df.to_csv(join(nnextrap_root_relpath, 'gen_data/01e_pred_extrapolation_wu.csv'))
+# save full data: variant table as csv and per-member predictions as memory-mappable .npy matrices
+save_predictions(join(nnextrap_root_relpath, 'gen_data/01e_pred_extrapolation_wu'), df, pred_all)
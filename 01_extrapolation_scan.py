@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# ## Score a full combinatorial site-saturation library with every model family
+# Variants are enumerated, encoded and scored in chunks and written to gen_data/scan_<positions>/,
+# memory use is the same for 20^4 and 20^6 variants
+
+import argparse
+import numpy as np
+from os.path import join
+from os import chdir
+from tqdm import tqdm
+
+from os.path import abspath
+import sys
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--positions', default='38,39,40,53', help='comma-separated mutated positions (0-indexed)')
+parser.add_argument('--models', default='lr,fcn,gcn,cnn', help='comma-separated model families')
+parser.add_argument('--output', default=None, help='output directory (default: gen_data/scan_<positions>)')
+parser.add_argument('--chunk_size', type=int, default=10000)
+parser.add_argument('--top_k', type=int, default=100)
+parser.add_argument('--save_members', action='store_true',
+                    help='also save the (variants x members) prediction matrix of each family')
+args = parser.parse_args()
+
+# for relative paths in nn4dms code to work properly, we need to set the current working
+# directory to the root of the project
+# we also need to add the code folder to the system path for imports to work properly
+print('Setting working directory to nn4dms root.')
+chdir('nn4dms_nn-extrapolate')
+module_path = abspath("code")
+if module_path not in sys.path:
+    sys.path.append(module_path)
+
+# add relative path to write directory (nn-extrapolation)
+nnextrap_root_relpath = ".."
+pretrained_dir = "nn-extrapolation-models/pretrained_models"
+
+import encode as enc
+import inference as inf
+import inference_lr as inf_lr
+
+from ensemble_tools import find_model_paths, EnsembleEvaluator, ensc_ensm
+from encoding_tools import SequenceEncoder
+from scan_tools import SiteSaturationScan, ScanStore, scan_library
+from instrumentation import METRICS, result_length
+
+# per-stage timings are written to gen_data/metrics at exit, set PIPELINE_METRICS=none to switch them off
+METRICS.report_at_exit(join(nnextrap_root_relpath, 'gen_data/metrics/01_extrapolation_scan.json'))
+encode = METRICS.wrap('enc.encode', enc.encode, items=result_length)
+restore_sess = METRICS.wrap('restore_sess', inf.restore_sess)
+run_inference = METRICS.wrap('run_inference', inf.run_inference, items=result_length)
+run_inference_lr = METRICS.wrap('run_inference', inf_lr.run_inference_lr, items=result_length)
+
+CHARS = ["A", "C", "D", "E", "F", "G", "H", "I", "K", "L",
+         "M", "N", "P", "Q", "R", "S", "T", "V", "W", "Y"]
+WT = "MQYKLILNGKTLKGETTTEAVDAATAEKVFKQYANDNGVDGEWTYDDATKTFTVTE"
+
+positions = [int(pos) for pos in args.positions.split(',')]
+models = args.models.split(',')
+output_dir = args.output or join(nnextrap_root_relpath, 'gen_data/scan_' + '_'.join(str(pos) for pos in positions))
+
+seq_encoder = SequenceEncoder(lambda seqs: encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=[aa for aa in WT]),
+                              CHARS, len(WT))
+scan = SiteSaturationScan(WT, positions, CHARS)
+store = ScanStore(output_dir, scan, top_k=args.top_k)
+print(f'Scanning {len(scan)} variants at positions {positions}, results in {output_dir}')
+
+# one family at a time, each pass re-enumerates the library so only one family is loaded at once
+ind_model_path = join(nnextrap_root_relpath, pretrained_dir, 'other_models/gb1_')
+for model in tqdm(models, total=len(models), ncols=100, desc="Model"):
+    ensemble = EnsembleEvaluator(find_model_paths(join(nnextrap_root_relpath, pretrained_dir, model+'s')))
+    with restore_sess(ind_model_path + model) as model_sess:
+        def score(encoded_variants):
+            # individual model used in the paper, lr requires separate inference to remove ph parameter
+            if model == 'lr':
+                pred = run_inference_lr(encoded_data=encoded_variants, sess=model_sess)
+            else:
+                pred = run_inference(encoded_data=encoded_variants, sess=model_sess)
+            # all members of the family are evaluated in one graph
+            pred_all = ensemble.predict(encoded_variants)
+            ensc, ensm = ensc_ensm(pred_all)
+            columns = {model+'_pred': np.asarray(pred, dtype=np.float32).ravel(),
+                       model+'_ensc': ensc, model+'_ensm': ensm}
+            if args.save_members:
+                columns[model+'_pred_all'] = pred_all
+            return columns
+
+        scan_library(scan, seq_encoder, score, store, chunk_size=args.chunk_size,
+                     progress=lambda chunks, total: tqdm(chunks, total=total, ncols=100, leave=False, desc='Chunk'))
+    ensemble.close()
+
+# writes the column summaries (quantiles and top variants) to scan.json
+store.close()
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import argparse
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-from os.path import isfile, join, exists
-from os import listdir, chdir
+from os.path import isfile, join
+from os import chdir
 from scipy.stats import spearmanr
 
 
@@ -13,6 +14,12 @@ from os.path import abspath
 import sys
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument('--additive', action='store_true',
+                    help='score LR neighbors from a site x amino acid effect table instead of the graph, '
+                         'predictions match the graph only to the tolerance of AdditiveModel.check')
+args = parser.parse_args()
+
 # for relative paths in nn4dms code to work properly, we need to set the current working
 # directory to the root of the project
 # we also need to add the code folder to the system path for imports to work properly
@@ -27,9 +34,20 @@ nnextrap_root_relpath = ".."
 pretrained_dir = "nn-extrapolation-models/pretrained_models"
 
 import encode as enc
-import inference as inf
-import inference_lr as inf_lr
-import design_tools as dt
+
+from encoding_tools import TrajectoryEncoder
+from additive_tools import AdditiveModel
+from ensemble_tools import find_model_paths, EnsembleEvaluator
+from prediction_cache import open_prediction_cache
+from serving_tools import open_inference_client
+from instrumentation import METRICS, result_length
+
+# per-stage timings are written to gen_data/metrics at exit, set PIPELINE_METRICS=none to switch them off
+METRICS.report_at_exit(join(nnextrap_root_relpath, 'gen_data/metrics/01_extrapolation_trajectories.json'))
+encode = METRICS.wrap('enc.encode', enc.encode, items=result_length)
+
+# with a running inference_server.py the ensembles are scored there and TensorFlow is never loaded here
+client = open_inference_client(join(nnextrap_root_relpath, 'gen_data/inference.sock'))
 
 
 CHARS = ["A", "C", "D", "E", "F", "G", "H", "I", "K", "L",
@@ -38,41 +56,27 @@ WT = "MQYKLILNGKTLKGETTTEAVDAATAEKVFKQYANDNGVDGEWTYDDATKTFTVTE"
 
 models = ['lr', 'fcn', 'gcn', 'cnn']
 
+# cache ensemble predictions across runs and scripts, set PREDICTION_CACHE=none to disable
+cache = open_prediction_cache(join(nnextrap_root_relpath, 'gen_data/prediction_cache.sqlite'))
+
 for direction in ['all', 'all_down', 'wt']:
     func_all_list = []
     label_list = []
 
     for model in models:
-        num_models = 100
-        found_models = []
-        model_paths = []
-        for i in range(num_models):
-            path = join(nnextrap_root_relpath, pretrained_dir, model+'s/model_'+str(i))
-            if (exists(path)):
-                for file_name in listdir(path):
-                    if '.pb' in file_name:
-                        model_name = file_name
-                        model_paths.append(path+'/'+model_name)
-                        found_models.append(i)
-        if len(model_paths) != num_models:
-            print('Could not find all models, missing models: ',
-                    ','.join([str(i) for i in range(100) if i not in found_models]))
-        model_sesses = []
-        for model_path in model_paths:
-            model_sesses.append(inf.restore_sess_from_pb(model_path))
+        # all members of the family are evaluated together in one graph
+        if client is not None:
+            ensemble = client.ensemble(model)
+        else:
+            ensemble = EnsembleEvaluator(find_model_paths(join(nnextrap_root_relpath, pretrained_dir, model+'s')))
 
         # calculate wt fitness for each model
         if direction == 'wt':
             seqs = [WT]
             func_all = []
-            encoded_variants = enc.encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=[aa for aa in WT])
+            encoded_variants = encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=[aa for aa in WT])
 
-            functions_all = []
-            for sess in model_sesses: # TODO: change back to all cnns
-                if model == 'lr':
-                    functions_all.append(inf_lr.run_inference_lr(encoded_data=encoded_variants, sess=sess))
-                else:
-                    functions_all.append(inf.run_inference(encoded_data=encoded_variants, sess=sess))
+            functions_all = ensemble.predict_cached(seqs, encoded_variants, cache).T
             functions = np.median(functions_all, axis=0)
             seqs_mut_df = pd.DataFrame(data=list(zip(seqs, np.array(functions_all).T, [functions])), 
                                        columns=['seq', 'func_all', 'func'])
@@ -85,6 +89,20 @@ for direction in ['all', 'all_down', 'wt']:
             func_all = []
             med_fits = []
             num_muts = 55
+            # keep the encoded trajectory sequence and patch one site per neighbor instead of re-encoding
+            traj_encoder = TrajectoryEncoder(lambda seqs: encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=[aa for aa in WT]),
+                                             WT, CHARS)
+            curr_seq = WT
+
+            # with --additive, linear regression members are scored from a site x amino acid effect table
+            # per member instead of the graph
+            additive = None
+            if args.additive and model == 'lr':
+                def score_seqs(seqs):
+                    encoded = None if client is not None else encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=[aa for aa in WT])
+                    return ensemble.predict_cached(seqs, encoded, cache)
+                additive = AdditiveModel.from_score_fn(score_seqs, WT, CHARS)
+                additive.check(score_seqs)
 
             for i in range(55): 
                 print("starting mutation ", i)
@@ -92,33 +110,38 @@ for direction in ['all', 'all_down', 'wt']:
 
                 # look at all possible neighbors
                 possible_muts = []
+                mut_poss = []
+                mut_aas = []
                 for pos in range(1, len(WT)):
                     if pos not in curr_poss: # don't mutate already mutated positions
                         for aa in CHARS:
                             if WT[pos] != aa: # not mutating to self
                                 mut = WT[pos]+str(pos)+aa
                                 possible_muts.append(mut)
+                                mut_poss.append(pos)
+                                mut_aas.append(aa)
 
                 # calculate fitness
-                join_muts = [curr_muts+[mut] for mut in possible_muts]
-                seqs = [dt.mut2seq(WT, muts) for muts in join_muts]
-                encoded_variants = enc.encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=[aa for aa in WT])
-
-                functions_all = []
-                for sess in model_sesses:
-                    if model == 'lr':
-                        functions_all.append(inf_lr.run_inference_lr(encoded_data=encoded_variants, sess=sess))
-                    else:
-                        functions_all.append(inf.run_inference(encoded_data=encoded_variants, sess=sess))
+                if additive is not None:
+                    functions_all = additive.neighbors(curr_seq, mut_poss, mut_aas).T
+                else:
+                    # neighbor strings are only built as keys for the prediction cache and the inference
+                    # server, which encodes the sequences itself
+                    seqs = [curr_seq[:pos] + aa + curr_seq[pos+1:] for pos, aa in zip(mut_poss, mut_aas)]
+                    encoded_variants = None if client is not None else traj_encoder.neighbors(mut_poss, mut_aas)
+                    functions_all = ensemble.predict_cached(seqs, encoded_variants, cache).T
                 functions = np.median(functions_all, axis=0)
                 # get next mutant in trajectory as min/max of median model prediction
-                seqs_mut_df = pd.DataFrame(data=list(zip(possible_muts, join_muts, seqs, np.array(functions_all).T, functions)), 
-                                           columns=['added_mut', 'join_mut', 'seq', 'func_all', 'func'])
+                seqs_mut_df = pd.DataFrame(data=list(zip(possible_muts, mut_poss, mut_aas, np.array(functions_all).T, functions)),
+                                           columns=['added_mut', 'pos', 'aa', 'func_all', 'func'])
                 if direction == 'all':
                     seqs_mut_df.sort_values('func', ascending=False, inplace=True)
                 else:
                     seqs_mut_df.sort_values('func', ascending=True, inplace=True)
                 curr_muts.append(seqs_mut_df.iloc[0]['added_mut'])
+                best_pos, best_aa = seqs_mut_df.iloc[0]['pos'], seqs_mut_df.iloc[0]['aa']
+                traj_encoder.apply(best_pos, best_aa)
+                curr_seq = curr_seq[:best_pos] + best_aa + curr_seq[best_pos+1:]
                 func_all.append(seqs_mut_df.iloc[0]['func_all'])
                 med_fits.append(seqs_mut_df.iloc[0]['func'])
                 num_muts -= 1
@@ -131,6 +154,12 @@ for direction in ['all', 'all_down', 'wt']:
             label_list.append(model+"_mut")
             label_list.append(model+"_func")
 
+        ensemble.close()
+
 
     func_df = pd.DataFrame(data=list(zip(*func_all_list)), columns=label_list)
     func_df.to_csv(join(nnextrap_root_relpath, 'gen_data/mut_func_'+direction+'.csv'))
+
+if cache is not None:
+    print(cache.report())
+    cache.close()
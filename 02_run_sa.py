@@ -10,8 +10,10 @@ import sys
 # directory to the root of the project
 # we also need to add the code folder to the system path for imports to work properly
 
+# the path is resolved from this file so that spawned batch workers, which start in the parent's
+# working directory, end up in the same place
 print('Setting working directory to nn4dms root.')
-os.chdir('nn4dms_nn-extrapolate')
+os.chdir(join(os.path.dirname(abspath(__file__)), 'nn4dms_nn-extrapolate'))
 module_path = abspath("code")
 if module_path not in sys.path:
     sys.path.append(module_path)
@@ -27,6 +29,17 @@ import numpy as np
 import sys
 import yaml
 import importlib
+import argparse
+import itertools
+from multiprocessing import Pool
+from os.path import splitext
+import pandas as pd
+
+from prediction_cache import open_prediction_cache, handler_model_id
+from sa_tools import MultiChainSA
+from additive_tools import AdditiveModel
+from serving_tools import open_inference_client
+from instrumentation import METRICS
 
 
 AAs = 'ACDEFGHIKLMNPQRSTVWY'
@@ -38,28 +51,265 @@ def load_config(config_file):
         except yaml.YAMLError as exc:
             print(exc)
 
-def run_simulated_annealing(config):
+# seq2fitness function, prediction cache and inference server client of the current process, loaded
+# once and reused across runs in batch mode. Only the handler of the last model is kept, so a worker
+# never holds more than one model family. Forked workers reload them instead of sharing the
+# parent's connections
+_process_id = None
+_process_cache = None
+_process_client = None
+_process_seq2fitness = {}
+_process_additive = {}
+
+
+def count_seqs(args, kwargs, result):
+    # seq2fitness is called with a list of sequences or a single sequence
+    return 1 if isinstance(args[0], str) else len(args[0])
+
+
+def default_checkpoint(seq2fitness_tools_name):
+    # individual model of the family, as restored by the 01_* scripts, e.g. other_models/gb1_lr
+    model = seq2fitness_tools_name.replace('seq2fitness_tools_', '', 1)
+    return join(nnextrap_root_relpath, pretrained_dir, 'other_models/gb1_' + model)
+
+
+def get_seq2fitness(seq2fitness_tools_name):
+    global _process_id, _process_cache, _process_client, _process_seq2fitness, _process_additive
+    if _process_id != os.getpid():
+        _process_id = os.getpid()
+        # cache fitness predictions across runs, keyed by the seq2fitness_tools module and its checkpoint
+        _process_cache = open_prediction_cache(join(nnextrap_root_relpath, 'gen_data/prediction_cache.sqlite'))
+        # handlers served by a running inference_server.py are used instead of loading the models here
+        _process_client = open_inference_client(join(nnextrap_root_relpath, 'gen_data/inference.sock'))
+        _process_seq2fitness = {}
+        _process_additive = {}
+    if seq2fitness_tools_name not in _process_seq2fitness:
+        _process_seq2fitness = {}
+        _process_additive = {}
+        with METRICS.timer('seq2fitness_load'):
+            if _process_client is not None and seq2fitness_tools_name in _process_client.models():
+                print('scoring with', seq2fitness_tools_name, 'on the inference server')
+                seq2fitness_model = _process_client.seq2fitness(seq2fitness_tools_name)
+                get_model_id = lambda: _process_client.models()[seq2fitness_tools_name]['model_id']
+            else:
+                seq2fitness_tools = importlib.__import__(seq2fitness_tools_name)
+                handler = seq2fitness_tools.seq2fitness_handler()
+                seq2fitness_model = handler.seq2fitness
+                get_model_id = lambda: handler_model_id(seq2fitness_tools_name, handler,
+                                                        default_checkpoint(seq2fitness_tools_name))
+        # model calls only, cache hits are timed by the outer seq2fitness stage
+        seq2fitness = METRICS.wrap('seq2fitness_model', seq2fitness_model, items=count_seqs)
+        if _process_cache is not None:
+            # keyed by a hash of the checkpoint the handler restores
+            model_id = get_model_id()
+            if not model_id:
+                raise ValueError('no checkpoint files found for ' + seq2fitness_tools_name +
+                                 ' on the inference server, set PREDICTION_CACHE=none to run without the cache')
+            seq2fitness = _process_cache.wrap(model_id, seq2fitness)
+        _process_seq2fitness[seq2fitness_tools_name] = METRICS.wrap('seq2fitness', seq2fitness, items=count_seqs)
+    return _process_seq2fitness[seq2fitness_tools_name], _process_cache
+
+
+def get_additive_model(seq2fitness_tools_name, WT):
+    '''
+    Effect table of a model that is additive over sites (the linear regression handlers), read off the
+    model once per process by scoring WT and all single mutants, and checked on random multi-mutants
+    '''
+    key = (seq2fitness_tools_name, WT)
+    if key not in _process_additive:
+        seq2fitness, _ = get_seq2fitness(seq2fitness_tools_name)
+        additive = AdditiveModel.from_score_fn(seq2fitness, WT, AAs)
+        print('additive fast path for', seq2fitness_tools_name, 'max error', additive.check(seq2fitness))
+        _process_additive[key] = additive
+    return _process_additive[key]
+
+
+def uses_additive(config):
+    # opt-in, the effect table matches the model only to the tolerance of AdditiveModel.check, so
+    # fitnesses (and near ties between designs) can differ slightly from the handler
+    return config.get('additive', False)
+
+
+def uses_multichain(config):
+    # checkpointing and trajectory logs are only supported by the repo-local MultiChainSA, which is a
+    # different optimizer than design_tools.SA_optimizer, so it is never switched on implicitly
+    if 'n_chains' not in config:
+        for key in ['checkpoint_file', 'trajectory_file']:
+            if key in config:
+                raise ValueError(key + ' requires n_chains, it is only supported by sa_tools.MultiChainSA')
+        return False
+    # MultiChainSA has its own schedule, so the temperature range is never defaulted
+    for key in ['T_max', 'T_min']:
+        if key not in config:
+            raise ValueError('n_chains requires ' + key + ', the temperature range of sa_tools.MultiChainSA')
+    return True
+
+
+def optimize(config, resume=False):
+    '''
+    Run simulated annealing for a config. With n_chains in the config, n_chains chains with seeds
+    seed, seed + 1, ... are advanced together and their proposals scored in one batched seq2fitness call.
+    With checkpoint_file in the config, the optimizer state is saved every checkpoint_every steps, and
+    with trajectory_file the trajectory is streamed to disk instead of kept in memory.
+    Args:
+        config: run config
+        resume: continue from checkpoint_file if it exists
+    Returns:
+        sa_optimizer: the optimizer, for plotting its trajectory
+        results: list of (seed, best_mut, fitness), one per chain
+    '''
     AA_options = [tuple([AA for AA in AAs]) for i in range(len(config['WT']))]
     AA_options.pop(0)
     AA_options.insert(0, ['M'])
 
-    seq2fitness_tools = importlib.__import__(config['seq2fitness_tools'])
-    seq2fitness_handler = seq2fitness_tools.seq2fitness_handler()
+    seq2fitness, cache = get_seq2fitness(config['seq2fitness_tools'])
+    additive = get_additive_model(config['seq2fitness_tools'], config['WT']) if uses_additive(config) else None
     print('setting up optimizer...')
-    sa_optimizer = tools.SA_optimizer(seq2fitness_handler.seq2fitness, config['WT'], AA_options,
-            config['num_mut'], mut_rate=config['mut_rate'], nsteps=config['nsteps'],
-            cool_sched=config['cool_sched'])
-    print('running optimization...')
-    best_mut, fitness = sa_optimizer.optimize(seed=config['seed'])
+    if uses_multichain(config):
+        # designs are scored from the mutations alone with the additive fast path
+        sa_optimizer = MultiChainSA(seq2fitness, config['WT'], AA_options, config['num_mut'],
+                config['T_max'], config['T_min'], mut_rate=config['mut_rate'], nsteps=config['nsteps'],
+                cool_sched=config['cool_sched'], mut2fitness=additive.score_muts if additive is not None else None)
+        seeds = [config['seed'] + chain for chain in range(config['n_chains'])]
+        run_files = {key: join(nnextrap_root_relpath, config[key]) if key in config else None
+                     for key in ['checkpoint_file', 'trajectory_file']}
+        print('running optimization...')
+        chain_results = sa_optimizer.optimize(seeds, checkpoint_every=config.get('checkpoint_every', 1000),
+                                              resume=resume, **run_files)
+        results = [(seed, best_mut, fitness) for seed, (best_mut, fitness) in zip(seeds, chain_results)]
+    else:
+        sa_optimizer = tools.SA_optimizer(additive.seq2fitness if additive is not None else seq2fitness,
+                config['WT'], AA_options, config['num_mut'], mut_rate=config['mut_rate'], nsteps=config['nsteps'],
+                cool_sched=config['cool_sched'])
+        print('running optimization...')
+        best_mut, fitness = sa_optimizer.optimize(seed=config['seed'])
+        results = [(config['seed'], best_mut, fitness)]
+    if cache is not None:
+        print(cache.report())
+    return sa_optimizer, results
+
+
+def run_simulated_annealing(config, resume=False):
+    sa_optimizer, results = optimize(config, resume=resume)
     with open(join(nnextrap_root_relpath, config['export_best_seqs']), 'wb') as f:
-        pickle.dump([best_mut, fitness], f)
+        if 'n_chains' in config:
+            pickle.dump([[best_mut, fitness] for _, best_mut, fitness in results], f)
+        else:
+            _, best_mut, fitness = results[0]
+            pickle.dump([best_mut, fitness], f)
 
     if config['save_plot_trajectory']:
         sa_optimizer.plot_trajectory(savefig_name=join(nnextrap_root_relpath, config['file_plot_trajectory']))
 
 
-if __name__ == '__main__':
-    print('running 02_run_sa.py', sys.argv[1])
-    config = load_config(sys.argv[1])
-    run_simulated_annealing(config)
+def load_batch_configs(batch_path):
+    '''
+    Expand a batch of runs from a directory of configs or a sweep spec
+    Args:
+        batch_path: directory of config files, or a sweep spec with a 'base' config (or 'base_config'
+            file), a 'sweep' dict of parameter lists whose cartesian product gives the runs, and
+            optionally the 'results' table to write
+    Returns:
+        configs: list of run configs
+        results_file: path of the consolidated results table
+    '''
+    if isdir(join(nnextrap_root_relpath, batch_path)):
+        config_files = sorted(f for f in os.listdir(join(nnextrap_root_relpath, batch_path))
+                              if f.endswith(('.txt', '.yml', '.yaml')))
+        configs = [load_config(join(batch_path, f)) for f in config_files]
+        return configs, join(batch_path, 'sa_batch_results.csv')
+
+    spec = load_config(batch_path)
+    base = dict(spec.get('base', {}))
+    if 'base_config' in spec:
+        base = dict(load_config(spec['base_config']), **base)
+    sweep = spec.get('sweep', {})
+    configs = []
+    for values in itertools.product(*sweep.values()):
+        configs.append(dict(base, **dict(zip(sweep.keys(), values))))
+    return configs, spec.get('results', splitext(batch_path)[0] + '_results.csv')
+
+
+def run_batch_config(run):
+    run_index, config, resume = run
+    try:
+        with METRICS.timer('sa_run'):
+            _, results = optimize(config, resume=resume)
+        rows = [dict(config, run_index=run_index, seed=seed, best_mut=best_mut, fitness=fitness, error='')
+                for seed, best_mut, fitness in results]
+    except Exception as exc:
+        rows = [dict(config, run_index=run_index, best_mut=None, fitness=np.nan, error=repr(exc))]
+    return rows
+
+
+def run_batch_task(task):
+    rows = []
+    for run in task:
+        rows += run_batch_config(run)
+    # worker metrics are sent back with the rows and merged into the parent's report
+    return rows, METRICS.snapshot()
+
 
+def model_name(run):
+    return str(run[1].get('seq2fitness_tools'))
+
+
+def batch_tasks(runs, workers):
+    '''
+    Split runs into tasks that each hold runs of a single model, so a worker only loads the models
+    of the tasks it is given. The runs of each model are split into up to workers tasks
+    '''
+    tasks = []
+    for _, model_runs in itertools.groupby(sorted(runs, key=model_name), key=model_name):
+        model_runs = list(model_runs)
+        chunk_size = -(-len(model_runs) // workers)
+        tasks += [model_runs[start:start + chunk_size] for start in range(0, len(model_runs), chunk_size)]
+    return tasks
+
+
+def run_batch(configs, results_file, workers=1, resume=False):
+    '''
+    Run many simulated annealing configs over a process pool and write one results table
+    Args:
+        configs: list of run configs
+        results_file: csv with one row per run and chain (config values, best_mut, fitness, error)
+        workers: number of worker processes, each loads a seq2fitness_tools module once
+        resume: continue runs from their checkpoint_file where it exists
+    '''
+    runs = [(run_index, config, resume) for run_index, config in enumerate(configs)]
+    tasks = batch_tasks(runs, workers)
+    if workers > 1:
+        with Pool(workers) as pool:
+            task_results = list(pool.imap_unordered(run_batch_task, tasks))
+    else:
+        task_results = [run_batch_task(task) for task in tasks]
+    rows = []
+    for task_rows, task_metrics in task_results:
+        rows += task_rows
+        METRICS.merge(task_metrics)
+    # the sort is stable, so the chains of a run keep their seed order and configs without a seed still sort
+    results = pd.DataFrame(sorted(rows, key=lambda row: row['run_index']))
+    results = results.drop(columns=[col for col in ['export_best_seqs', 'save_plot_trajectory', 'file_plot_trajectory']
+                                    if col in results.columns])
+    results.to_csv(join(nnextrap_root_relpath, results_file), index=False)
+    print(f'{len(results)} runs, {(results.error != "").sum()} failed, results written to {results_file}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('config', help='config file, or with --batch a sweep spec or directory of configs')
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--results', default=None, help='results table for --batch, overrides the sweep spec')
+    parser.add_argument('--resume', action='store_true', help='continue from the checkpoint_file of each config')
+    args = parser.parse_args()
+    # per-stage timings are written to gen_data/metrics at exit, set PIPELINE_METRICS=none to switch them off
+    METRICS.report_at_exit(join(nnextrap_root_relpath, 'gen_data/metrics/02_run_sa.json'))
+    print('running 02_run_sa.py', args.config)
+    if args.batch:
+        configs, results_file = load_batch_configs(args.config)
+        run_batch(configs, args.results or results_file, workers=args.workers, resume=args.resume)
+    else:
+        config = load_config(args.config)
+        with METRICS.timer('sa_run'):
+            run_simulated_annealing(config, resume=args.resume)
@@ -6,71 +6,67 @@ from os import listdir
 import pandas as pd
 import sys
 import subprocess
+import argparse
+import shutil
+from multiprocessing import Pool
+from os import remove
+from glob import glob
 
-def get_read_data(all_data):
-    '''
-    Given a line from an NGS file, return the name, sequence, and quality scores of the read
-    Args:
-        all_data: string containing name, read, +, quality
-    Returns:
-        name: identifier for the read
-        read: DNA sequences read
-        quality: quality scores corresponding to each position in the read
-    '''
-
-    all_data = all_data.split('\n')
-    name = all_data[0] 
-    try:
-        read = all_data[1]
-    except:
-        print(all_data)
-    quality = all_data[3]
-    return name, read, quality
-
-
-def process_read_pair(fwd_all_data, rev_all_data):
-    '''
-    Take a pair of reads (including their metadata), align them and return a compiled read
-    Args:
-        fwd_all_data: raw string contain name, read, +, quality for the forward read
-        rev_all_data: raw string contain name, read, +, quality for the reverse read
-    Returns:
-        A processed read: aligned reads, select nucleotide with highest quality score for each position
-    '''
-
-    fwd_name, fwd_read, fwd_quality = get_read_data(fwd_all_data)
-    rev_name, rev_read, rev_quality = get_read_data(rev_all_data)
-    dna_seqs_final = []
-    complement = {'C':'G', 'G':'C', 'A':'T', 'T':'A', 'N':'N'}
-    if len(fwd_read) != len(fwd_quality) or len(rev_read) != len(rev_quality):
-        print('read and quality score lengths not the same!')
-    # take reverse complement
-    fwd_read = ''.join([complement[fwd_read[len(fwd_read) - i - 1]] for i in range(len(fwd_read))])
-    # convert quality scores to int
-    rev_quality = [ord(q) - 33 for q in rev_quality]
-    fwd_quality = [ord(fwd_quality[len(fwd_quality) - i - 1]) - 33 for i in range(len(fwd_quality))]
-    # merge reads
-    sequence = [None]*270
-    for i in range(270):
-        if i < 151:
-            base = rev_read[i]
-        if i >= 151 or (i >= 119 and i < 151 and rev_quality[i] < fwd_quality[i-119]):
-            base = fwd_read[i-119]
-        sequence[i] = base
-    return ''.join(sequence)
+from fastq_tools import fastq_num_chunks, fastq_format, resolve_fastq_path
+from count_tools import init_count_worker, new_count_vectors
+from instrumentation import METRICS
+from manifest_tools import CountManifest, file_fingerprint, design_set_hash
+from sra_tools import fetch_runs, count_task, DOWNLOAD_COMMAND, STREAM_COMMAND
 
 
 if __name__ == '__main__':
     '''
     inputs:
-        input_directory: directory that holds all the fastq files (make sure to unzip them)
+        input_directory: directory that holds all the fastq files, plain or gzip/zstd compressed (.fastq.gz/.fastq.zst)
         date: date the NGS was performed on, used for naming outputs
         merged_reads_directory: place to store merged read files, intermediate files
         input_seq_df: filed that should contain a column called 'dna_seq' which has the nucleotide seq we want to match
         output_counts_file: where to output the counts for each NGS file
+        --skip_merged_reads: count reads as they are merged without writing merged read files
+        --workers: number of worker processes, file pairs are split into chunks of --chunk_reads read pairs
+        --max_mismatches: rescue reads within 1 or 2 mismatches of a design into separate count columns
+        --manifest_directory: where counts of processed pairs are kept, pairs whose files and settings
+            are unchanged are not processed again (default: merged_reads_directory/count_manifest)
+        --reprocess: process every pair even if its counts are in the manifest
+        --fetch: download pairs missing from input_directory from the SRA, up to --fetch_workers at a time,
+            and count each pair as soon as its download finishes
+        --stream: count pairs missing from input_directory straight from the SRA without saving the FASTQ files
+        --run_info: SRA run table with Run and LibraryName columns (default: input_directory/*_run_info.csv)
+        --downloader / --stream_command: command templates replacing fasterq-dump, see sra_tools
     '''
-    _, input_directory, date, merged_reads_directory, input_seq_df, output_counts_file = sys.argv
-    seq_df = pd.read_csv(input_seq_df)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_directory')
+    parser.add_argument('date')
+    parser.add_argument('merged_reads_directory')
+    parser.add_argument('input_seq_df')
+    parser.add_argument('output_counts_file')
+    parser.add_argument('--skip_merged_reads', action='store_true')
+    parser.add_argument('--batch_size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--chunk_reads', type=int, default=1000000)
+    parser.add_argument('--max_mismatches', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--manifest_directory', default=None)
+    parser.add_argument('--reprocess', action='store_true')
+    parser.add_argument('--fetch', action='store_true')
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--run_info', default=None)
+    parser.add_argument('--fetch_workers', type=int, default=4)
+    parser.add_argument('--fetch_retries', type=int, default=3)
+    parser.add_argument('--fetch_backoff', type=float, default=30)
+    parser.add_argument('--downloader', default=DOWNLOAD_COMMAND)
+    parser.add_argument('--stream_command', default=STREAM_COMMAND)
+    args = parser.parse_args()
+    # per-stage timings are written to gen_data/metrics at exit, set PIPELINE_METRICS=none to switch them off
+    METRICS.report_at_exit('gen_data/metrics/03_preprocessing.json')
+    input_directory = args.input_directory
+    merged_reads_directory = args.merged_reads_directory
+    seq_df = pd.read_csv(args.input_seq_df)
+    dna_seqs = seq_df['dna_seq'].values.tolist()
 
     # read file names
     paired_file_paths = pd.read_csv(join(input_directory, 'sra_file_pairs.csv'))
@@ -79,77 +75,163 @@ if __name__ == '__main__':
     merged_reads_output_names = ['both_reads'.join(file.split('R1')) for file in paired_file_paths.R1]
     read_descriptors = [file.split('R1')[0] for file in paired_file_paths.R1]
 
-    # save output stats here to print report when done
-    output_stats = []
-
-    # explicitly identify r1 and r2 files while keeping with `file_name_pair` naming scheme below
-    for r1_file, r2_file, merged_reads_output_name in tqdm(zip(paired_file_paths.R1, paired_file_paths.R2, merged_reads_output_names), total=len(paired_file_paths), ncols=100, leave=True, desc='File'):
-        file_name_pair = [r1_file, r2_file]
-        read_count = 0
-        fwd_all_data = ''
-        rev_all_data = ''
-
-        # open read files
-        f1 = open(join(input_directory, file_name_pair[0]), 'r')
-        f2 = open(join(input_directory, file_name_pair[1]), 'r')
-        
-        # write empty merged read file
-        with open(join(merged_reads_directory, merged_reads_output_name), 'w') as f:
-            f.write('')
-
-        # open in appending mode
-        out_file = open(join(merged_reads_directory, merged_reads_output_name), 'a')
-        for l1, l2 in tqdm(zip(f1, f2), leave=False, desc='Processing reads'):
-            # if a new read description is identified and compiled fwd/rev_all_data is not '',
-            # then fwd/rev_all_data is complete read. Process and identify read.
-            if l1[0] == '@' and l2[0] == '@' and fwd_all_data != '' and rev_all_data != '':
-                final_sequence = process_read_pair(fwd_all_data, rev_all_data)
-                out_file.write(final_sequence + '\n')
-                read_count += 1
-
-                # reset fwd/rev_all_data to ''
-                fwd_all_data = ''
-                rev_all_data = ''
-            
-            # append fastq data to fwd/rev_all_data until complete read data is compiled
-            # i.e. read descriptor, sequence, description, and quality scores.
-            fwd_all_data += l1
-            rev_all_data += l2
-
-        # for loop does not process last read in file - do that here
-        final_sequence = process_read_pair(fwd_all_data, rev_all_data)
-        out_file.write(final_sequence + '\n')
-        read_count += 1
-
-        # save output stats
-        output_stats.append((*file_name_pair, read_count))
-
-        # close files
-        f1.close()
-        f2.close()
-        out_file.close()
+    # pairs missing from input_directory are downloaded (--fetch) or streamed (--stream) from the SRA
+    remote_runs = {}
+    if args.fetch or args.stream:
+        run_info_file = args.run_info
+        if run_info_file is None:
+            run_info_files = glob(join(input_directory, '*_run_info.csv'))
+            if not run_info_files:
+                parser.error(f'no *_run_info.csv in {input_directory}, pass the SRA run table with --run_info')
+            run_info_file = run_info_files[0]
+        run_info = pd.read_csv(run_info_file)
+        remote_runs = {f'{name}_R1.fastq': (run, name) for run, name in zip(run_info.Run, run_info.LibraryName)}
+
+    # counts of pairs processed by earlier runs are reused while their files and the settings are unchanged
+    manifest = CountManifest(args.manifest_directory or join(merged_reads_directory, 'count_manifest'))
+    settings = {'designs': design_set_hash(dna_seqs), 'max_mismatches': args.max_mismatches}
+    pair_counts = [None for _ in read_descriptors]
+    pair_stats = [None for _ in read_descriptors]
+    fingerprints = [None for _ in read_descriptors]
+    merged_part_files = [[] for _ in read_descriptors]
+    pending_chunks = [0 for _ in read_descriptors]
+
+    def reuse_saved(pair_index, merged_output):
+        # take the counts of an unchanged pair from the manifest
+        r1_file = paired_file_paths.R1[pair_index]
+        saved = None if args.reprocess else manifest.lookup(r1_file, fingerprints[pair_index], settings, merged_output)
+        if saved is not None:
+            print(f'{r1_file}: unchanged, using counts from the manifest')
+            pair_counts[pair_index], pair_stats[pair_index] = saved
+            return True
+        pair_counts[pair_index] = new_count_vectors(len(seq_df), args.max_mismatches)
+        pair_stats[pair_index] = {'reads': 0, 'matched': 0, 'rescued': 0, 'ambiguous': 0}
+        return False
+
+    def chunk_tasks(pair_index, fwd_file, rev_file):
+        # split a file pair into record-aligned chunks, a single chunk per pair when running serially
+        merged_reads_output_name = merged_reads_output_names[pair_index]
+        with METRICS.timer('fingerprint', 2):
+            fingerprints[pair_index] = [file_fingerprint(fwd_file), file_fingerprint(rev_file)]
+        merged_output = None if args.skip_merged_reads else join(merged_reads_directory, merged_reads_output_name)
+        if reuse_saved(pair_index, merged_output):
+            return []
+        # compressed files are streamed whole, uncompressed files are split by byte range. Only the chunk
+        # count is estimated here, each worker finds the record boundaries of its own chunk
+        if args.workers > 1 and fastq_format(fwd_file) == 'fastq' and fastq_format(rev_file) == 'fastq':
+            num_chunks = fastq_num_chunks(fwd_file, args.chunk_reads)
+        else:
+            num_chunks = 1
+        pair_tasks = []
+        for chunk in range(num_chunks):
+            merged_file = merged_output
+            if merged_file is not None and num_chunks > 1:
+                merged_file += f'.part{chunk}'
+                merged_part_files[pair_index].append(merged_file)
+            pair_tasks.append({'pair_index': pair_index, 'chunk': chunk, 'fwd_file': fwd_file, 'rev_file': rev_file,
+                               'num_chunks': num_chunks,
+                               'num_designs': len(seq_df), 'merged_file': merged_file,
+                               'batch_size': args.batch_size, 'progress': args.workers <= 1})
+        return pair_tasks
+
+    def stream_task(pair_index, run):
+        # a streamed pair is counted in one piece, its fingerprint is the SRA run it came from
+        fingerprints[pair_index] = [{'sra_run': run}]
+        merged_output = None if args.skip_merged_reads else join(merged_reads_directory, merged_reads_output_names[pair_index])
+        if reuse_saved(pair_index, merged_output):
+            return []
+        return [{'pair_index': pair_index, 'chunk': 0, 'run': run, 'stream_command': args.stream_command,
+                 'retries': args.fetch_retries, 'backoff': args.fetch_backoff, 'num_designs': len(seq_df),
+                 'merged_file': merged_output, 'batch_size': args.batch_size, 'progress': args.workers <= 1}]
+
+    local_pairs = []
+    remote_pairs = []
+    for pair_index, (r1_file, r2_file) in enumerate(zip(paired_file_paths.R1, paired_file_paths.R2)):
+        try:
+            local_pairs.append((pair_index, resolve_fastq_path(join(input_directory, r1_file)),
+                                resolve_fastq_path(join(input_directory, r2_file))))
+        except FileNotFoundError:
+            if r1_file not in remote_runs:
+                raise
+            remote_pairs.append(pair_index)
+
+    # tasks of pairs on disk come first, then those of remote pairs as their downloads finish. The task
+    # list is filled as tasks are handed out, so counting starts while later runs are still downloading
+    tasks = []
+    fetch_errors = []
+
+    def add_tasks(pair_index, pair_tasks):
+        pending_chunks[pair_index] = len(pair_tasks)
+        for task in pair_tasks:
+            tasks.append(task)
+            yield task
+
+    def iter_tasks():
+        for pair_index, fwd_file, rev_file in local_pairs:
+            yield from add_tasks(pair_index, chunk_tasks(pair_index, fwd_file, rev_file))
+        if args.stream:
+            for pair_index in remote_pairs:
+                yield from add_tasks(pair_index, stream_task(pair_index, remote_runs[paired_file_paths.R1[pair_index]][0]))
+            return
+        runs = [remote_runs[paired_file_paths.R1[pair_index]] for pair_index in remote_pairs]
+        pair_index_of_run = {run: pair_index for (run, _), pair_index in zip(runs, remote_pairs)}
+        try:
+            for run, _, fwd_file, rev_file in fetch_runs(runs, input_directory, args.downloader, args.fetch_workers,
+                                                         args.fetch_retries, args.fetch_backoff):
+                pair_index = pair_index_of_run[run]
+                yield from add_tasks(pair_index, chunk_tasks(pair_index, fwd_file, rev_file))
+        except RuntimeError as exc:
+            # the pairs that were downloaded are still counted and stored in the manifest
+            fetch_errors.append(exc)
+
+    # merge reads, picking the higher quality base across the R1/R2 overlap, and count them
+    if args.workers > 1:
+        pool = Pool(args.workers, initializer=init_count_worker, initargs=(dna_seqs, args.max_mismatches))
+        results = pool.imap(count_task, iter_tasks())
+    else:
+        init_count_worker(dna_seqs, args.max_mismatches)
+        results = map(count_task, iter_tasks())
+    # results come back in task order, and each task is in the list before it is handed out
+    for task_index, (counts, stats, chunk_metrics) in enumerate(tqdm(results, ncols=100, leave=True, desc='Chunk')):
+        task = tasks[task_index]
+        METRICS.merge(chunk_metrics)
+        for suffix in counts:
+            pair_counts[task['pair_index']][suffix] += counts[suffix]
+        for stat in stats:
+            pair_stats[task['pair_index']][stat] += stats[stat]
+        pending_chunks[task['pair_index']] -= 1
+        if pending_chunks[task['pair_index']] > 0:
+            continue
+
+        # all chunks of the pair are done: stitch merged read chunks back together in file order and
+        # record the pair in the manifest, so a crash later in the run does not lose it
+        pair_index = task['pair_index']
+        if merged_part_files[pair_index]:
+            with METRICS.timer('stitch_merged'), open(join(merged_reads_directory, merged_reads_output_names[pair_index]), 'wb') as out_file:
+                for part_file in merged_part_files[pair_index]:
+                    with open(part_file, 'rb') as f:
+                        shutil.copyfileobj(f, out_file)
+                    remove(part_file)
+        manifest.store(paired_file_paths.R1[pair_index], fingerprints[pair_index], settings,
+                       pair_counts[pair_index], pair_stats[pair_index])
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    if fetch_errors:
+        sys.exit(f'{fetch_errors[0]}, rerun to fetch them, the counted pairs are kept in the manifest')
+
+    # exact counts go in the *_count columns, reads rescued with mismatches in *_rescued_count / *_ambiguous_count
+    for suffix in pair_counts[0]:
+        for read_descriptor, counts in zip(read_descriptors, pair_counts):
+            seq_df[read_descriptor + suffix] = counts[suffix]
 
     # print output_stats
     print('All reads filtered for quality scores, final read counts:')
-    for r1_file, r2_file, read_cnt in output_stats:
-        print(f"Experiment: {r1_file.split('R1')[0]}  --  Total reads: {read_cnt}")
-
-    print('Identifying reads in filtered fastq files...')
-    unsorted_counts = None
-    for merged_reads_output_name, read_descriptor in tqdm(zip(merged_reads_output_names, read_descriptors), total=len(paired_file_paths), ncols=100, leave=True, desc='File'):
-        # open merged reads again
-        with open(join(merged_reads_directory, merged_reads_output_name), 'r') as f:
-            sequences = f.read().split('\n')
-        possible_sequences = seq_df['dna_seq'].values.tolist()
-
-        # calculate counts (add a count to a possible sequence if the read matches exactly)
-        # counts index matches that of sequence index
-        counts = [0 for _ in possible_sequences]
-        for i, sequence in enumerate(sequences):
-            sequence = sequence[58:223]  # this is the unique protein sequence in the read
-            if sequence in possible_sequences:
-                counts[possible_sequences.index(sequence)] += 1
-        seq_df[read_descriptor + 'count'] = counts
-    
+    for r1_file, stats in zip(paired_file_paths.R1, pair_stats):
+        report = f"Experiment: {r1_file.split('R1')[0]}  --  Total reads: {stats['reads']}  --  Matched reads: {stats['matched']}"
+        if args.max_mismatches > 0:
+            report += f"  --  Rescued reads: {stats['rescued']}  --  Ambiguous reads: {stats['ambiguous']}"
+        print(report)
+
     # add date here to distinguish different counts file outputs
-    seq_df.to_csv(date+'_'+output_counts_file, index=False)
+    seq_df.to_csv(args.date+'_'+args.output_counts_file, index=False)
@@ -0,0 +1,153 @@
+"""Closed-form scoring of models that are additive over sites, such as the linear regression models."""
+
+import numpy as np
+
+from encoding_tools import INVALID_CHAR
+from instrumentation import METRICS
+
+
+class AdditiveModel:
+    '''
+    Site x amino acid effect table of a model whose prediction is a sum of per-site terms, e.g. a
+    linear regression on a per-residue encoding such as "one_hot,aa_index". The table is read off the
+    model by scoring WT and every single mutant once, effects[pos, aa] = f(single mutant) - f(WT),
+    which equals the difference of the model weights at that site. A variant then scores as
+    f(WT) + the sum of the effects of its mutations, a gather of num_mut table entries instead of
+    a model call. Models with several outputs (e.g. the members of an ensemble) get one table
+    column per output.
+    '''
+
+    def __init__(self, wt, chars, wt_score, effects):
+        '''
+        Args:
+            wt: parent sequence the effects are relative to
+            chars: amino acids, in the order of the second axis of effects
+            wt_score: prediction for wt, a scalar or an array (num_outputs,)
+            effects: array (seq_len, num_chars) or (seq_len, num_chars, num_outputs), 0 at the WT residues
+        '''
+        self.wt = wt
+        self.chars = list(chars)
+        self.wt_score = np.asarray(wt_score, dtype=np.float64)
+        self.effects = np.asarray(effects, dtype=np.float64)
+        self.lut = np.full(256, INVALID_CHAR, dtype=np.uint8)
+        for i, aa in enumerate(self.chars):
+            self.lut[ord(aa)] = i
+        self.sites = np.arange(len(wt))
+
+    def to_indices(self, seqs, seq_len=None):
+        '''
+        Map equal-length sequences to indices into chars
+        Args:
+            seqs: list of sequences
+            seq_len: length of the sequences, by default that of the first one
+        Returns:
+            uint8 array (num_seqs, seq_len)
+        Raises:
+            ValueError if a sequence contains a character outside chars, so it cannot get a plausible score
+        '''
+        if seq_len is None:
+            seq_len = len(seqs[0]) if seqs else 0
+        indices = self.lut[np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)].reshape(len(seqs), seq_len)
+        if (indices == INVALID_CHAR).any():
+            raise ValueError('sequences contain characters without an effect in the table')
+        return indices
+
+    @classmethod
+    def from_score_fn(cls, score_fn, wt, chars):
+        '''
+        Build the effect table by scoring WT and all of its single mutants in one call
+        Args:
+            score_fn: maps a list of sequences to an array (num_seqs,) or (num_seqs, num_outputs)
+            wt: parent sequence
+            chars: amino acids that can appear at any site
+        Returns:
+            AdditiveModel
+        '''
+        chars = list(chars)
+        singles = [(pos, i) for pos in range(len(wt)) for i, aa in enumerate(chars) if aa != wt[pos]]
+        seqs = [wt] + [wt[:pos] + chars[i] + wt[pos + 1:] for pos, i in singles]
+        with METRICS.timer('additive_probe', len(seqs)):
+            scores = np.asarray(score_fn(seqs), dtype=np.float64)
+        wt_score = scores[0]
+        effects = np.zeros((len(wt), len(chars)) + scores.shape[1:], dtype=np.float64)
+        positions, aa_indices = zip(*singles)
+        effects[list(positions), list(aa_indices)] = scores[1:] - wt_score
+        return cls(wt, chars, wt_score, effects)
+
+    def check(self, score_fn, num_variants=100, num_mut=10, seed=0, rtol=1e-4, atol=1e-4):
+        '''
+        Compare the table to the model on random multi-mutants, e.g. right after from_score_fn
+        Args:
+            score_fn: the function the table was built from
+            num_variants: number of random variants
+            num_mut: mutations per variant
+            seed: seed of the random variants
+            rtol, atol: tolerances of np.allclose
+        Returns:
+            largest absolute difference between the table and the model
+        Raises:
+            ValueError if the model is not additive within the tolerances
+        '''
+        rng = np.random.RandomState(seed)
+        seqs = []
+        for _ in range(num_variants):
+            seq = list(self.wt)
+            for pos in rng.choice(len(self.wt), min(num_mut, len(self.wt)), replace=False):
+                seq[pos] = self.chars[rng.randint(len(self.chars))]
+            seqs.append(''.join(seq))
+        expected = np.asarray(score_fn(seqs), dtype=np.float64)
+        scores = self.score(seqs)
+        if not np.allclose(scores, expected, rtol=rtol, atol=atol):
+            raise ValueError('model is not additive over sites, max difference {:.3g}'.format(np.abs(scores - expected).max()))
+        return float(np.abs(scores - expected).max())
+
+    def score(self, seqs):
+        '''
+        Score full sequences
+        Args:
+            seqs: list of sequences of the length of wt
+        Returns:
+            array (num_seqs,) or (num_seqs, num_outputs)
+        '''
+        with METRICS.timer('additive_score', len(seqs)):
+            indices = self.to_indices(seqs, len(self.wt))
+            return self.wt_score + self.effects[self.sites, indices].sum(axis=1)
+
+    def seq2fitness(self, seqs):
+        '''
+        Same call signature as seq2fitness_handler.seq2fitness: a list of sequences or a single sequence
+        '''
+        if isinstance(seqs, str):
+            return self.score([seqs])[0]
+        return self.score(seqs)
+
+    def score_muts(self, muts):
+        '''
+        Score designs given as mutations from wt, e.g. the designs of MultiChainSA
+        Args:
+            muts: list of dicts from position (0-indexed) to substituted amino acid, all with the same
+                number of mutations
+        Returns:
+            array (num_designs,) or (num_designs, num_outputs)
+        '''
+        with METRICS.timer('additive_score', len(muts)):
+            positions = np.array([list(mut) for mut in muts], dtype=np.intp).reshape(len(muts), -1)
+            aa_indices = self.to_indices([''.join(mut.values()) for mut in muts])
+            return self.wt_score + self.effects[positions, aa_indices].sum(axis=1)
+
+    def neighbors(self, parent, positions, aas):
+        '''
+        Score single-mutant neighbors of a parent sequence, e.g. one step of a trajectory
+        Args:
+            parent: parent sequence
+            positions: list of mutated positions (0-indexed), one per neighbor
+            aas: list of substituted amino acids, one per neighbor
+        Returns:
+            array (num_neighbors,) or (num_neighbors, num_outputs)
+        '''
+        with METRICS.timer('additive_score', len(positions)):
+            parent_indices = self.to_indices([parent])[0]
+            positions = np.asarray(positions, dtype=np.intp)
+            aa_indices = self.to_indices([''.join(aas)])[0]
+            parent_score = self.wt_score + self.effects[self.sites, parent_indices].sum(axis=0)
+            return parent_score + self.effects[positions, aa_indices] - self.effects[positions, parent_indices[positions]]
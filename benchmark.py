@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# ## Time the pipeline stages on synthetic data with NumPy stand-in models
+# Throughput of each stage is written to a JSON file that can be compared against a run from another commit
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from benchmark_tools import (CHARS, WT, StandInEncoder, StandInEnsemble, StandInSeq2FitnessHandler, StandInSession,
+                             random_variants, write_synthetic_fastq)
+from count_tools import (MismatchIndex, build_design_index, design_region_keys, match_merged_batch,
+                         merge_and_count_read_pairs, new_count_vectors)
+from encoding_tools import SequenceEncoder, TrajectoryEncoder
+from fastq_tools import iter_fastq_file, iter_read_pair_batches, merge_read_pair_batch, process_read_pair
+from sa_tools import MultiChainSA
+from scan_tools import ScanStore, SiteSaturationScan, scan_library
+
+
+STAGES = ['merge_reference', 'merge', 'match_exact', 'match_mismatch', 'merge_count',
+          'encode_reference', 'encode', 'ensemble', 'trajectory', 'sa', 'scan']
+
+
+def time_best(fn, repeat):
+    # best of several runs, fn returns the number of items it processed
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), items
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def record_to_string(record):
+    # the raw record text process_read_pair expects
+    return '\n'.join([bytes(field).decode() for field in record[:2]] + ['+', bytes(record[2]).decode()])
+
+
+def benchmark_stages(args, data_dir):
+    '''
+    Build the benchmark inputs and return a function per stage that runs it once
+    Returns:
+        dict from stage name to (unit, fn), fn returns the number of units processed
+    '''
+    designs_df = pd.read_csv(args.designs)
+    if args.num_designs:
+        designs_df = designs_df.iloc[:args.num_designs]
+    dna_seqs = designs_df.dna_seq.tolist()
+    write_synthetic_fastq(data_dir, designs_df, args.reads, error_rate=args.error_rate, seed=args.seed)
+    fwd_file, rev_file = join(data_dir, 'synthetic_R1.fastq'), join(data_dir, 'synthetic_R2.fastq')
+
+    def read_pairs():
+        return iter_read_pair_batches(iter_fastq_file(fwd_file), iter_fastq_file(rev_file), batch_size=args.batch_size)
+
+    merged = np.concatenate([merge_read_pair_batch(fwd, rev) for fwd, rev in read_pairs()])
+    keys = design_region_keys(merged)
+    design_index = build_design_index(dna_seqs)
+    unmatched_keys = [keys[i] for i in np.flatnonzero(match_merged_batch(keys, design_index) < 0)]
+    mismatch_index = MismatchIndex(dna_seqs, 1)
+    reference_pairs = []
+    for fwd_batch, rev_batch in read_pairs():
+        reference_pairs += [(record_to_string(fwd), record_to_string(rev)) for fwd, rev in zip(fwd_batch, rev_batch)]
+        if len(reference_pairs) >= args.reference_reads:
+            break
+    reference_pairs = reference_pairs[:args.reference_reads]
+
+    stand_in_encoder = StandInEncoder(seed=args.seed)
+    variants = random_variants(args.variants, 4, seed=args.seed)
+    seq_encoder = SequenceEncoder(stand_in_encoder.encode, CHARS, len(WT))
+    num_features = stand_in_encoder.table.shape[1]
+    ensemble = StandInEnsemble(args.members, len(WT), num_features, hidden=args.hidden, seed=args.seed)
+    encoded_variants = seq_encoder.encode(variants)
+    handler = StandInSeq2FitnessHandler(num_members=args.members, hidden=args.hidden, seed=args.seed)
+
+    def merge_reference():
+        for fwd, rev in reference_pairs:
+            process_read_pair(fwd, rev)
+        return len(reference_pairs)
+
+    def merge():
+        return sum(len(merge_read_pair_batch(fwd, rev)) for fwd, rev in read_pairs())
+
+    def match_exact():
+        for start in range(0, len(merged), args.batch_size):
+            match_merged_batch(design_region_keys(merged[start:start + args.batch_size]), design_index)
+        return len(merged)
+
+    def match_mismatch():
+        for key in unmatched_keys:
+            mismatch_index.match(key)
+        return len(unmatched_keys)
+
+    def merge_count():
+        counts = new_count_vectors(len(dna_seqs))
+        fwd_records, rev_records = iter_fastq_file(fwd_file), iter_fastq_file(rev_file)
+        return merge_and_count_read_pairs(fwd_records, rev_records, design_index, counts, batch_size=args.batch_size)['reads']
+
+    def encode_reference():
+        for start in range(0, len(variants), args.chunk_size):
+            stand_in_encoder.encode(variants[start:start + args.chunk_size])
+        return len(variants)
+
+    def encode():
+        return sum(len(chunk) for chunk, _ in seq_encoder.iter_chunks(variants, args.chunk_size))
+
+    def ensemble_inference():
+        for start in range(0, len(encoded_variants), args.chunk_size):
+            ensemble.predict(encoded_variants[start:start + args.chunk_size])
+        return len(encoded_variants)
+
+    def trajectory():
+        # greedy uphill walk over single mutants, as in 01_extrapolation_trajectories.py
+        traj_encoder = TrajectoryEncoder(stand_in_encoder.encode, WT, CHARS)
+        curr_poss = []
+        scored = 0
+        for _ in range(args.traj_steps):
+            mut_poss, mut_aas = zip(*[(pos, aa) for pos in range(1, len(WT)) if pos not in curr_poss
+                                      for aa in CHARS if aa != WT[pos]])
+            functions = np.median(ensemble.predict(traj_encoder.neighbors(mut_poss, mut_aas)), axis=1)
+            best = int(np.argmax(functions))
+            traj_encoder.apply(mut_poss[best], mut_aas[best])
+            curr_poss.append(mut_poss[best])
+            scored += len(mut_poss)
+        return scored
+
+    def site_saturation_scan():
+        # enumeration, encoding, column writes and summaries of a scan, scored by a single linear model
+        scan = SiteSaturationScan(WT, list(range(38, 38 + args.scan_sites)), CHARS[1:])
+        scan_encoder = SequenceEncoder(stand_in_encoder.encode, CHARS[1:], len(WT))
+        linear = StandInSession(1, len(WT), num_features, hidden=0, seed=args.seed)
+        store = ScanStore(join(data_dir, 'scan'), scan)
+        scan_library(scan, scan_encoder, lambda encoded: {'pred': linear.run(None, {'x': encoded})[:, 0]}, store,
+                     chunk_size=args.chunk_size)
+        store.close()
+        return len(scan)
+
+    def simulated_annealing():
+        AA_options = [tuple(CHARS[1:]) for _ in WT]
+        AA_options[0] = ['M']
+        sa_optimizer = MultiChainSA(handler.seq2fitness, WT, AA_options, args.sa_num_mut, 1.0, 0.01,
+                                    nsteps=args.sa_steps)
+        sa_optimizer.optimize([args.seed + chain for chain in range(args.sa_chains)])
+        return args.sa_steps * args.sa_chains
+
+    return {'merge_reference': ('reads', merge_reference), 'merge': ('reads', merge),
+            'match_exact': ('reads', match_exact), 'match_mismatch': ('reads', match_mismatch),
+            'merge_count': ('reads', merge_count), 'encode_reference': ('seqs', encode_reference),
+            'encode': ('seqs', encode), 'ensemble': ('seqs', ensemble_inference),
+            'trajectory': ('seqs', trajectory), 'sa': ('chain_steps', simulated_annealing),
+            'scan': ('variants', site_saturation_scan)}
+
+
+def compare_results(results, baseline, tolerance):
+    '''
+    Print the throughput of each stage relative to a baseline file
+    Returns:
+        list of stages that are slower than the baseline by more than tolerance
+    '''
+    if baseline['params'] != results['params']:
+        print('warning: baseline was run with different parameters')
+    regressions = []
+    print('{:<18}{:>16}{:>16}{:>10}'.format('stage', 'baseline/s', 'current/s', 'ratio'))
+    for stage, result in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        old = baseline['stages'][stage]['throughput']
+        ratio = result['throughput'] / old if old else float('nan')
+        flag = ''
+        if ratio < 1 - tolerance:
+            regressions.append(stage)
+            flag = '  slower'
+        print('{:<18}{:>16.1f}{:>16.1f}{:>10.2f}{}'.format(stage, old, result['throughput'], ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    '''
+    Time the pipeline stages on synthetic data with NumPy stand-in models, write the throughput of each
+    stage to a JSON file and optionally compare it to a baseline written by an earlier commit
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='gen_data/benchmark.json', help='where to write the results')
+    parser.add_argument('--compare', default=None, help='baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--designs', default='designs.csv')
+    parser.add_argument('--num_designs', type=int, default=0, help='use the first designs only, 0 for all')
+    parser.add_argument('--reads', type=int, default=200000)
+    parser.add_argument('--reference_reads', type=int, default=20000)
+    parser.add_argument('--error_rate', type=float, default=0.002)
+    parser.add_argument('--batch_size', type=int, default=10000)
+    parser.add_argument('--variants', type=int, default=100000)
+    parser.add_argument('--chunk_size', type=int, default=10000)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--hidden', type=int, default=32)
+    parser.add_argument('--traj_steps', type=int, default=5)
+    parser.add_argument('--sa_steps', type=int, default=200)
+    parser.add_argument('--sa_chains', type=int, default=8)
+    parser.add_argument('--sa_num_mut', type=int, default=10)
+    parser.add_argument('--scan_sites', type=int, default=4)
+    args = parser.parse_args()
+
+    params = {key: value for key, value in vars(args).items() if key not in ['output', 'compare', 'tolerance', 'stages', 'repeat']}
+    results = {'commit': git_commit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+               'cpu_count': os.cpu_count(), 'params': params, 'stages': {}}
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        print('generating synthetic data...')
+        stages = benchmark_stages(args, data_dir)
+        for stage in args.stages:
+            unit, fn = stages[stage]
+            seconds, items = time_best(fn, args.repeat)
+            results['stages'][stage] = {'seconds': seconds, 'items': items, 'unit': unit,
+                                        'throughput': items / seconds if seconds else float('nan')}
+            print('{:<18}{:>12.3f} s{:>16.1f} {}/s'.format(stage, seconds, items / seconds, unit))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to', args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            print('stages slower than the baseline:', ', '.join(regressions))
+            sys.exit(1)
@@ -0,0 +1,209 @@
+"""Synthetic sequencing data and NumPy stand-in models for benchmarking the pipeline."""
+
+import os
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from count_tools import DESIGN_START, DESIGN_END
+from ensemble_tools import EnsembleEvaluator
+from fastq_tools import COMPLEMENT_LUT, MERGED_LENGTH, OVERLAP_START, READ_LENGTH
+
+
+CHARS = ["*", "A", "C", "D", "E", "F", "G", "H", "I", "K", "L",
+         "M", "N", "P", "Q", "R", "S", "T", "V", "W", "Y"]
+WT = "MQYKLILNGKTLKGETTTEAVDAATAEKVFKQYANDNGVDGEWTYDDATKTFTVTE"
+
+# binned NovaSeq quality scores, sequencing errors get the low ones
+HIGH_QUALITIES = np.frombuffer(b'FFFFFFFF:,', dtype=np.uint8)
+LOW_QUALITIES = np.frombuffer(b',#', dtype=np.uint8)
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def amplicon_flanks(designs_df, seed=0):
+    '''
+    Build the constant sequence around the design region of the 270 bp merged amplicon. The cloning
+    sites are taken from final_dna_seq, the rest of the flanks is a fixed random sequence
+    Args:
+        designs_df: designs.csv with dna_seq and final_dna_seq columns
+        seed: seed of the random part of the flanks
+    Returns:
+        prefix: bases 0 to DESIGN_START of the amplicon
+        suffix: bases DESIGN_END to MERGED_LENGTH of the amplicon
+    '''
+    dna_seq, final_dna_seq = designs_df[['dna_seq', 'final_dna_seq']].values[0]
+    start = final_dna_seq.index(dna_seq)
+    left, right = final_dna_seq[:start], final_dna_seq[start + len(dna_seq):]
+    rng = np.random.RandomState(seed)
+    pad = BASES[rng.randint(4, size=MERGED_LENGTH)].tobytes().decode()
+    prefix = (pad + left)[-DESIGN_START:]
+    suffix = (right + pad)[:MERGED_LENGTH - DESIGN_END]
+    return prefix, suffix
+
+
+def add_errors(reads, qualities, error_rate, rng):
+    # substitute bases at random and give them low quality scores, in place
+    errors = rng.rand(*reads.shape) < error_rate
+    base_index = np.searchsorted(BASES, reads[errors])
+    reads[errors] = BASES[(base_index + rng.randint(1, 4, size=len(base_index))) % 4]
+    qualities[errors] = LOW_QUALITIES[rng.randint(len(LOW_QUALITIES), size=len(base_index))]
+
+
+def fastq_bytes(reads, qualities, first_read, name):
+    return b''.join(b'@%s.%d\n%s\n+\n%s\n' % (name, first_read + i, read.tobytes(), quality.tobytes())
+                    for i, (read, quality) in enumerate(zip(reads, qualities)))
+
+
+def write_synthetic_fastq(out_dir, designs_df, num_reads, error_rate=0.002, seed=0, name='synthetic',
+                          abundance_sigma=1.0, chunk_size=100000):
+    '''
+    Write a pair of FASTQ files with the amplicon layout of the GB1 libraries: R2 reads merged bases
+    0-150, R1 is the reverse complement of bases 119-269 and the design sits at DESIGN_START:DESIGN_END
+    Args:
+        out_dir: directory for {name}_R1.fastq, {name}_R2.fastq and sra_file_pairs.csv
+        designs_df: designs.csv, reads are drawn from its dna_seq column
+        num_reads: number of read pairs
+        error_rate: per-base substitution rate, applied to R1 and R2 independently
+        seed: seed for design abundances, reads and errors
+        name: prefix of the file names
+        abundance_sigma: designs are drawn with log-normal abundances of this spread, 0 for uniform
+        chunk_size: number of read pairs generated at a time
+    Returns:
+        array with the number of reads drawn from each design
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    prefix, suffix = amplicon_flanks(designs_df, seed)
+    amplicons = np.frombuffer(''.join(prefix + dna_seq + suffix for dna_seq in designs_df.dna_seq).encode(),
+                              dtype=np.uint8).reshape(len(designs_df), MERGED_LENGTH)
+    abundance = rng.lognormal(sigma=abundance_sigma, size=len(designs_df)) if abundance_sigma > 0 else np.ones(len(designs_df))
+    abundance /= abundance.sum()
+    true_counts = np.zeros(len(designs_df), dtype=np.int64)
+
+    r1_file, r2_file = name + '_R1.fastq', name + '_R2.fastq'
+    with open(join(out_dir, r1_file), 'wb') as f1, open(join(out_dir, r2_file), 'wb') as f2:
+        for first_read in range(0, num_reads, chunk_size):
+            n = min(chunk_size, num_reads - first_read)
+            drawn = rng.choice(len(designs_df), size=n, p=abundance)
+            true_counts += np.bincount(drawn, minlength=len(designs_df))
+            rev_reads = amplicons[drawn, :READ_LENGTH].copy()
+            fwd_reads = COMPLEMENT_LUT[amplicons[drawn, OVERLAP_START:][:, ::-1]]
+            rev_quals = HIGH_QUALITIES[rng.randint(len(HIGH_QUALITIES), size=rev_reads.shape)]
+            fwd_quals = HIGH_QUALITIES[rng.randint(len(HIGH_QUALITIES), size=fwd_reads.shape)]
+            add_errors(rev_reads, rev_quals, error_rate, rng)
+            add_errors(fwd_reads, fwd_quals, error_rate, rng)
+            f1.write(fastq_bytes(fwd_reads, fwd_quals, first_read, name.encode()))
+            f2.write(fastq_bytes(rev_reads, rev_quals, first_read, name.encode()))
+    pd.DataFrame({'R1': [r1_file], 'R2': [r2_file]}).to_csv(join(out_dir, 'sra_file_pairs.csv'))
+    return true_counts
+
+
+def random_variants(num_variants, num_mut, seed=0, wt=WT, chars=CHARS):
+    '''
+    Draw random variants of wt with num_mut substitutions each, the first residue is kept
+    Returns:
+        list of sequences
+    '''
+    rng = np.random.RandomState(seed)
+    aas = [aa for aa in chars if aa != '*']
+    variants = []
+    for _ in range(num_variants):
+        seq = list(wt)
+        for pos in rng.choice(np.arange(1, len(wt)), num_mut, replace=False):
+            seq[pos] = aas[rng.randint(len(aas))]
+        variants.append(''.join(seq))
+    return variants
+
+
+class StandInEncoder:
+    '''
+    Stand-in for enc.encode(encoding="one_hot,aa_index", ...): a one-hot block followed by a fixed
+    random block of 19 features per residue, encoded one sequence at a time like the reference encoder.
+    '''
+
+    def __init__(self, chars=CHARS, num_index_features=19, seed=0):
+        self.chars = list(chars)
+        rng = np.random.RandomState(seed)
+        self.table = np.concatenate([np.eye(len(self.chars)), rng.randn(len(self.chars), num_index_features)],
+                                    axis=1).astype(np.float32)
+        self.char_index = {aa: i for i, aa in enumerate(self.chars)}
+
+    def encode(self, char_seqs):
+        return np.stack([self.table[[self.char_index[aa] for aa in seq]] for seq in char_seqs])
+
+
+class StandInSession:
+    '''
+    NumPy stand-in for a TensorFlow session holding one or more models. Members with hidden > 0 are
+    one hidden layer networks (like the fcn models), hidden=0 gives linear regression members.
+    run() returns predictions of shape (num_variants, num_members) for the first fed array.
+    '''
+
+    def __init__(self, num_members, seq_length, num_features, hidden=100, seed=0):
+        rng = np.random.RandomState(seed)
+        num_inputs = seq_length * num_features
+        self.hidden = hidden
+        if hidden > 0:
+            self.w1 = (rng.randn(num_members, num_inputs, hidden) / np.sqrt(num_inputs)).astype(np.float32)
+            self.b1 = rng.randn(num_members, hidden).astype(np.float32)
+            self.w2 = (rng.randn(num_members, hidden) / np.sqrt(hidden)).astype(np.float32)
+        else:
+            self.w2 = (rng.randn(num_inputs, num_members) / np.sqrt(num_inputs)).astype(np.float32)
+        self.b2 = rng.randn(num_members).astype(np.float32)
+
+    def run(self, fetches, feed_dict):
+        encoded_data = np.asarray(list(feed_dict.values())[0], dtype=np.float32)
+        x = encoded_data.reshape(len(encoded_data), -1)
+        if self.hidden == 0:
+            return x.dot(self.w2) + self.b2
+        # (num_members, num_variants, hidden) activations, one matrix product per member
+        activations = np.maximum(np.matmul(x, self.w1) + self.b1[:, None, :], 0)
+        return np.matmul(activations, self.w2[:, :, None])[:, :, 0].T + self.b2
+
+    def close(self):
+        pass
+
+
+def run_inference(encoded_data, sess, batch_size=64):
+    '''
+    Stand-in for inference.run_inference: score encoded variants with a single-member session in batches
+    Returns:
+        array (num_variants,) of predictions
+    '''
+    predictions = [sess.run(None, {'raw_seqs': encoded_data[i:i + batch_size]})[:, 0]
+                   for i in range(0, len(encoded_data), batch_size)]
+    return np.concatenate(predictions) if predictions else np.empty(0, dtype=np.float32)
+
+
+class StandInEnsemble(EnsembleEvaluator):
+    '''
+    EnsembleEvaluator whose stacked graph is replaced by a StandInSession, so the chunking and
+    caching code paths run without TensorFlow or the pretrained models.
+    '''
+
+    def __init__(self, num_members, seq_length, num_features, hidden=100, seed=0, chunk_size=4096):
+        super().__init__(['standin_model_' + str(i) for i in range(num_members)], chunk_size=chunk_size)
+        self.standin_args = (num_members, seq_length, num_features, hidden, seed)
+        self._model_id = 'standin:' + ','.join(str(arg) for arg in self.standin_args)
+
+    def _load(self):
+        self.raw_seqs_ph = 'raw_seqs'
+        self.predictions = None
+        self.sess = StandInSession(*self.standin_args)
+
+
+class StandInSeq2FitnessHandler:
+    '''
+    Stand-in for seq2fitness_tools.seq2fitness_handler: seq2fitness maps a list of sequences (or a single
+    sequence) to the median prediction of an ensemble, encoding the sequences on every call.
+    '''
+
+    def __init__(self, num_members=100, hidden=100, seed=0, wt=WT):
+        self.encoder = StandInEncoder(seed=seed)
+        self.ensemble = StandInEnsemble(num_members, len(wt), self.encoder.table.shape[1], hidden=hidden, seed=seed)
+
+    def seq2fitness(self, seqs):
+        if isinstance(seqs, str):
+            return self.seq2fitness([seqs])[0]
+        return np.median(self.ensemble.predict(self.encoder.encode(seqs)), axis=1)
@@ -0,0 +1,257 @@
+"""Match merged reads to the designed DNA library and count them."""
+
+import numpy as np
+from tqdm import tqdm
+
+from instrumentation import METRICS
+from fastq_tools import (fastq_pair_chunk, iter_fastq_file, iter_read_pair_batches, merge_read_pair_batch,
+                         merged_batch_to_bytes)
+
+
+# position of the designed protein coding region in the merged read
+DESIGN_START = 58
+DESIGN_END = 223
+
+
+def build_design_index(dna_seqs):
+    '''
+    Build a hash index from design DNA sequence to its row in the design table
+    Args:
+        dna_seqs: list of designed DNA sequences (e.g. the 'dna_seq' column of designs.csv)
+    Returns:
+        dict mapping the ASCII bytes of each sequence to its index, duplicates keep the first index
+    '''
+    index = {}
+    for i, seq in enumerate(dna_seqs):
+        index.setdefault(str(seq).encode(), i)
+    return index
+
+
+def design_region_keys(merged):
+    '''
+    Extract the designed region of each merged read as hashable keys
+    Args:
+        merged: uint8 array of shape (num_reads, merged_length) holding merged reads as ASCII
+    Returns:
+        list of bytes, one per read
+    '''
+    region = np.ascontiguousarray(merged[:, DESIGN_START:DESIGN_END])
+    width = region.shape[1]
+    buffer = region.tobytes()
+    return [buffer[i:i + width] for i in range(0, len(buffer), width)]
+
+
+def match_merged_batch(keys, design_index):
+    '''
+    Look up the exact design match of each read
+    Args:
+        keys: list of design region keys from design_region_keys
+        design_index: dict from build_design_index
+    Returns:
+        int64 array with the matched design index of each read, -1 for reads without an exact match
+    '''
+    get = design_index.get
+    return np.array([get(key, -1) for key in keys], dtype=np.int64)
+
+
+def count_merged_batch(merged, design_index, counts):
+    '''
+    Add exact matches of a batch of merged reads to a count vector
+    Args:
+        merged: uint8 array of shape (num_reads, merged_length) holding merged reads as ASCII
+        design_index: dict from build_design_index
+        counts: int64 count vector with one entry per design, updated in place
+    Returns:
+        number of reads in the batch that matched a design
+    '''
+    hits = match_merged_batch(design_region_keys(merged), design_index)
+    hits = hits[hits >= 0]
+    counts += np.bincount(hits, minlength=len(counts))
+    return len(hits)
+
+
+class MismatchIndex:
+    '''
+    Pigeonhole seed index for matching reads to designs with up to max_mismatches substitutions.
+    The designs are cut into max_mismatches + 1 disjoint segments, and a read within max_mismatches
+    of a design must share at least one segment with it exactly, so only designs sharing a segment
+    with the read are compared base by base.
+    '''
+
+    def __init__(self, dna_seqs, max_mismatches):
+        '''
+        Args:
+            dna_seqs: list of designed DNA sequences, all of the same length
+            max_mismatches: maximum number of substitutions tolerated between a read and a design
+        '''
+        self.max_mismatches = max_mismatches
+        dna_seqs = [str(seq).encode() for seq in dna_seqs]
+        self.seq_length = len(dna_seqs[0])
+        if any(len(seq) != self.seq_length for seq in dna_seqs):
+            raise ValueError('mismatch matching requires designed sequences of equal length')
+        self.designs = np.frombuffer(b''.join(dna_seqs), dtype=np.uint8).reshape(len(dna_seqs), self.seq_length)
+        bounds = np.linspace(0, self.seq_length, max_mismatches + 2).astype(int)
+        self.segments = list(zip(bounds[:-1], bounds[1:]))
+        self.tables = []
+        for start, end in self.segments:
+            table = {}
+            for i, seq in enumerate(dna_seqs):
+                table.setdefault(seq[start:end], []).append(i)
+            self.tables.append(table)
+
+    def match(self, key):
+        '''
+        Find the designs closest to a read within max_mismatches substitutions
+        Args:
+            key: design region of the read as bytes
+        Returns:
+            array of indices of the designs at the smallest Hamming distance, empty if none are close enough
+        '''
+        if len(key) != self.seq_length:
+            return np.empty(0, dtype=np.int64)
+        candidates = set()
+        for (start, end), table in zip(self.segments, self.tables):
+            candidates.update(table.get(key[start:end], ()))
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        read = np.frombuffer(key, dtype=np.uint8)
+        distances = (self.designs[candidates] != read).sum(axis=1)
+        best = distances.min()
+        if best > self.max_mismatches:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(candidates[distances == best])
+
+
+def new_count_vectors(num_designs, max_mismatches=0):
+    '''
+    Create the count vectors filled in while counting one experiment
+    Args:
+        num_designs: number of designs in the library
+        max_mismatches: mismatches tolerated when rescuing reads, 0 for exact matching only
+    Returns:
+        dict from count column suffix to int64 count vector. 'count' holds exact matches, with
+        max_mismatches > 0 'rescued_count' holds reads uniquely assigned within max_mismatches and
+        'ambiguous_count' counts, for each design, reads tied between it and other designs
+    '''
+    suffixes = ['count']
+    if max_mismatches > 0:
+        suffixes += ['rescued_count', 'ambiguous_count']
+    return {suffix: np.zeros(num_designs, dtype=np.int64) for suffix in suffixes}
+
+
+def merge_and_count_read_pairs(fwd_records, rev_records, design_index, counts, out_file=None, batch_size=10000,
+                               progress=False, mismatch_index=None):
+    '''
+    Merge paired reads in batches and count matches to the designs
+    Args:
+        fwd_records: iterable of (name, read, quality) records from the R1 file
+        rev_records: iterable of (name, read, quality) records from the R2 file
+        design_index: dict from build_design_index
+        counts: dict of count vectors from new_count_vectors, updated in place
+        out_file: binary file to write merged reads to, None to skip writing them
+        batch_size: number of read pairs merged at a time
+        progress: show a progress bar over reads
+        mismatch_index: MismatchIndex used to rescue reads without an exact match, None for exact matching only
+    Returns:
+        dict with the number of merged reads ('reads'), exact matches ('matched'), reads rescued
+        with mismatches ('rescued') and reads tied between several designs ('ambiguous')
+    '''
+    stats = {'reads': 0, 'matched': 0, 'rescued': 0, 'ambiguous': 0}
+    num_designs = len(counts['count'])
+    # reading the next batch covers FASTQ parsing and, for compressed files, decompression
+    batches = METRICS.timed_iter('fastq_parse', iter_read_pair_batches(fwd_records, rev_records, batch_size=batch_size),
+                                 items=lambda batch: len(batch[0]))
+    with tqdm(leave=False, desc='Processing reads', unit='reads', disable=not progress) as pbar:
+        for fwd_batch, rev_batch in batches:
+            with METRICS.timer('merge', len(fwd_batch)):
+                merged = merge_read_pair_batch(fwd_batch, rev_batch)
+            if out_file is not None:
+                with METRICS.timer('write_merged', len(merged)):
+                    out_file.write(merged_batch_to_bytes(merged))
+            with METRICS.timer('match', len(merged)):
+                keys = design_region_keys(merged)
+                hits = match_merged_batch(keys, design_index)
+                exact = hits[hits >= 0]
+                counts['count'] += np.bincount(exact, minlength=num_designs)
+            stats['matched'] += len(exact)
+            if mismatch_index is not None:
+                unmatched = np.flatnonzero(hits < 0)
+                with METRICS.timer('mismatch_rescue', len(unmatched)):
+                    for i in unmatched:
+                        best = mismatch_index.match(keys[i])
+                        if len(best) == 1:
+                            counts['rescued_count'][best[0]] += 1
+                            stats['rescued'] += 1
+                        elif len(best) > 1:
+                            counts['ambiguous_count'][best] += 1
+                            stats['ambiguous'] += 1
+            stats['reads'] += len(merged)
+            pbar.update(len(merged))
+    return stats
+
+
+# design indexes of the current worker process, set by init_count_worker
+_worker_design_index = None
+_worker_mismatch_index = None
+
+
+def init_count_worker(dna_seqs, max_mismatches=0):
+    '''
+    Build the design indexes once per worker process
+    Args:
+        dna_seqs: list of designed DNA sequences
+        max_mismatches: mismatches tolerated when rescuing reads, 0 for exact matching only
+    '''
+    global _worker_design_index, _worker_mismatch_index
+    with METRICS.timer('build_design_index', len(dna_seqs)):
+        _worker_design_index = build_design_index(dna_seqs)
+        _worker_mismatch_index = MismatchIndex(dna_seqs, max_mismatches) if max_mismatches > 0 else None
+
+
+def count_records(task, fwd_records, rev_records):
+    '''
+    Merge and count read pairs with the design indexes of the current worker
+    Args:
+        task: dict with num_designs, merged_file, batch_size and progress, see count_read_pair_chunk
+        fwd_records: iterable of (name, read, quality) records from the R1 file
+        rev_records: iterable of (name, read, quality) records from the R2 file
+    Returns:
+        counts: dict of count vectors, see new_count_vectors
+        stats: dict of read statistics, see merge_and_count_read_pairs
+    '''
+    max_mismatches = 0 if _worker_mismatch_index is None else _worker_mismatch_index.max_mismatches
+    counts = new_count_vectors(task['num_designs'], max_mismatches)
+    out_file = open(task['merged_file'], 'wb') if task['merged_file'] is not None else None
+    try:
+        stats = merge_and_count_read_pairs(
+            fwd_records, rev_records, _worker_design_index, counts, out_file=out_file, batch_size=task['batch_size'],
+            progress=task['progress'], mismatch_index=_worker_mismatch_index)
+    finally:
+        if out_file is not None:
+            out_file.close()
+    return counts, stats
+
+
+def count_read_pair_chunk(task):
+    '''
+    Merge and count the read pairs in one record-aligned chunk of an R1/R2 file pair
+    Args:
+        task: dict with keys
+            fwd_file, rev_file: paths to the R1 and R2 FASTQ files, optionally gzip or zstd compressed
+            chunk, num_chunks: index of the chunk and number of chunks of the pair, the byte ranges of the
+                chunk are found here with fastq_pair_chunk
+            num_designs: length of the count vectors
+            merged_file: path to write merged reads of the chunk to, None to skip writing them
+            batch_size: number of read pairs merged at a time
+            progress: show a progress bar over reads
+    Returns:
+        counts: dict of count vectors for the chunk, see new_count_vectors
+        stats: dict of read statistics for the chunk, see merge_and_count_read_pairs
+        metrics: stage timings of the chunk, to be merged into the parent's METRICS
+    '''
+    with METRICS.timer('fastq_pair_chunk'):
+        fwd_range, rev_range = fastq_pair_chunk(task['fwd_file'], task['rev_file'], task['chunk'], task['num_chunks'])
+    counts, stats = count_records(task, iter_fastq_file(task['fwd_file'], *fwd_range),
+                                  iter_fastq_file(task['rev_file'], *rev_range))
+    return counts, stats, METRICS.snapshot()
@@ -0,0 +1,170 @@
+"""Sequence encoding helpers that avoid re-encoding full sequences."""
+
+import numpy as np
+
+from instrumentation import METRICS
+
+
+# marks characters in the lookup table that have no encoding
+INVALID_CHAR = 255
+
+
+class SequenceEncoder:
+    '''
+    Vectorized per-residue encoder. Sequences are mapped to residue indices through a uint8 lookup
+    table and encoded by indexing a (num_chars, num_features) feature table, which is taken from
+    encode_fn once so the output matches it exactly. Variants can be encoded in fixed-size chunks
+    so memory does not grow with the size of the library.
+    '''
+
+    def __init__(self, encode_fn, chars, seq_length):
+        '''
+        Args:
+            encode_fn: reference encoder mapping a list of sequences to an array (num_seqs, seq_len, num_features),
+                e.g. lambda seqs: enc.encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=list(WT))
+            chars: characters that can appear in the sequences
+            seq_length: length of the sequences
+        '''
+        self.chars = list(chars)
+        probes = encode_fn([aa * seq_length for aa in self.chars])
+        if not np.array_equal(probes, np.broadcast_to(probes[:, :1], probes.shape)):
+            raise ValueError('encoding is not per-residue and cannot be computed from a lookup table')
+        self.features = np.ascontiguousarray(probes[:, 0])
+        self.lut = np.full(256, INVALID_CHAR, dtype=np.uint8)
+        for i, aa in enumerate(self.chars):
+            self.lut[ord(aa)] = i
+
+    def to_indices(self, seqs):
+        '''
+        Map equal-length sequences to residue indices
+        Args:
+            seqs: list of sequences
+        Returns:
+            uint8 array (num_seqs, seq_len)
+        '''
+        if not seqs:
+            return np.empty((0, 0), dtype=np.uint8)
+        ascii_seqs = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8).reshape(len(seqs), -1)
+        indices = self.lut[ascii_seqs]
+        if (indices == INVALID_CHAR).any():
+            raise ValueError('sequences contain characters that cannot be encoded')
+        return indices
+
+    def to_sequences(self, indices):
+        '''
+        Map residue indices back to sequences
+        Args:
+            indices: integer array (num_seqs, seq_len)
+        Returns:
+            list of sequences
+        '''
+        char_codes = np.frombuffer(''.join(self.chars).encode(), dtype=np.uint8)
+        seq_length = indices.shape[1]
+        buffer = char_codes[indices].tobytes().decode()
+        return [buffer[i:i + seq_length] for i in range(0, len(buffer), seq_length)]
+
+    def encode_indices(self, indices):
+        '''
+        Encode residue indices from to_indices
+        Args:
+            indices: integer array (num_seqs, seq_len)
+        Returns:
+            array (num_seqs, seq_len, num_features)
+        '''
+        with METRICS.timer('encode', len(indices)):
+            return self.features[indices]
+
+    def encode(self, seqs):
+        '''
+        Encode a list of equal-length sequences
+        Args:
+            seqs: list of sequences
+        Returns:
+            array (num_seqs, seq_len, num_features)
+        '''
+        return self.encode_indices(self.to_indices(seqs))
+
+    def iter_chunks(self, seqs, chunk_size=10000):
+        '''
+        Encode sequences in fixed-size chunks, e.g. to feed them straight into inference
+        Args:
+            seqs: iterable of sequences, may be a generator
+            chunk_size: number of sequences per chunk
+        Returns:
+            generator of (chunk_seqs, encoded_chunk)
+        '''
+        chunk = []
+        for seq in seqs:
+            chunk.append(seq)
+            if len(chunk) == chunk_size:
+                yield chunk, self.encode(chunk)
+                chunk = []
+        if chunk:
+            yield chunk, self.encode(chunk)
+
+    def substitution_indices(self, wt, positions, variants):
+        '''
+        Build residue indices of combinatorial variants of wt without building the sequences
+        Args:
+            wt: parent sequence
+            positions: list of mutated positions (0-indexed)
+            variants: list of strings with the residue at each of the positions, e.g. 'VDGV'
+        Returns:
+            uint8 array (num_variants, seq_len)
+        '''
+        indices = np.repeat(self.to_indices([wt]), len(variants), axis=0)
+        if len(variants):
+            indices[:, positions] = self.to_indices(list(variants))
+        return indices
+
+
+class TrajectoryEncoder(SequenceEncoder):
+    '''
+    Keeps the encoding of a parent sequence and builds encoded single-mutant neighbors by patching
+    one site per row with the feature table of SequenceEncoder. Works for per-residue encodings such
+    as "one_hot,aa_index", where the features at a position depend only on the residue at that position.
+    '''
+
+    def __init__(self, encode_fn, wt, chars, max_neighbors=None):
+        '''
+        Args:
+            encode_fn: function mapping a list of sequences to an encoded array (num_seqs, seq_len, num_features),
+                e.g. lambda seqs: enc.encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=list(wt))
+            wt: starting parent sequence
+            chars: amino acids that can be substituted in
+            max_neighbors: size of the preallocated neighbor batch, defaults to all single mutants of wt
+        '''
+        super().__init__(encode_fn, chars, len(wt))
+        self.parent = self.encode([wt])[0]
+        if max_neighbors is None:
+            max_neighbors = len(wt) * (len(self.chars) - 1)
+        self.neighbor_buffer = np.empty((max_neighbors,) + self.parent.shape, dtype=self.parent.dtype)
+
+    def neighbors(self, positions, aas):
+        '''
+        Encode single-mutant neighbors of the current parent
+        Args:
+            positions: list of mutated positions (0-indexed), one per neighbor
+            aas: list of substituted amino acids, one per neighbor
+        Returns:
+            array (num_neighbors, seq_len, num_features). This is a view into a buffer that is reused
+            by the next call, copy it if it needs to outlive the step
+        '''
+        num_neighbors = len(positions)
+        with METRICS.timer('encode_neighbors', num_neighbors):
+            if num_neighbors > len(self.neighbor_buffer):
+                self.neighbor_buffer = np.empty((num_neighbors,) + self.parent.shape, dtype=self.parent.dtype)
+            batch = self.neighbor_buffer[:num_neighbors]
+            batch[:] = self.parent
+            if num_neighbors:
+                batch[np.arange(num_neighbors), positions] = self.features[self.to_indices([''.join(aas)])[0]]
+        return batch
+
+    def apply(self, position, aa):
+        '''
+        Make a single mutant of the current parent the new parent
+        Args:
+            position: mutated position (0-indexed)
+            aa: substituted amino acid
+        '''
+        self.parent[position] = self.features[self.to_indices([aa])[0, 0]]
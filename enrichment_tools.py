@@ -0,0 +1,225 @@
+"""Frequencies, enrichments and replicate averages of the sorted design libraries."""
+
+import numpy as np
+
+
+# count columns from 03_preprocessing.py that add up to each sort. Sorts ending in _0 are from
+# experiment 2 (binding bins), sorts ending in _1 and _2 are the two replicates of experiment 1
+SORT_COLUMNS = {
+    'us_0': ['expt2_unsorted_count'],
+    'high_0': ['expt2_bind_hi_count', 'expt2_bind_hi_more_reads_count'],
+    'low_0': ['expt2_bind_low_count', 'expt2_bind_low_more_reads_count'],
+    'wteq_0': ['expt2_bind_wt_count'],
+    'disp_0': ['expt2_display_count'],
+    'us_1': ['expt1_unsorted_rep1_count', 'expt1_unsorted_rep1_more_reads_count'],
+    'bind_1': ['expt1_bind_rep1_count', 'expt1_bind_rep1_more_reads_count'],
+    'disp_1': ['expt1_display_rep1_count'],
+    'us_2': ['expt1_unsorted_rep2_count'],
+    'bind_2': ['expt1_bind_rep2_count', 'expt1_bind_rep2_more_reads_count'],
+    'disp_2': ['expt1_display_rep2_count', 'expt1_display_rep2_more_reads_count'],
+}
+
+# designs need more than READ_CUT reads in each of these unsorted libraries
+READ_CUT = 10
+FILTER_SORTS = ['us_1', 'us_2']
+PSEUDOCOUNT = 1
+
+
+def calc_enrich(wt_unsel, wt_sel, vars_unsel, vars_sel):
+    '''
+    Calculate enrichment for a list of variants
+    Args:
+        wt_unsel: WT count in unsorted population
+        wt_sel: WT count in sorted population
+        vars_unsel: numpy array of variant counts in unsorted population
+        vars_sel: numpy array of variant counts in sorted population
+    Returns:
+        numpy array containing enrichment scores for all variants
+    '''
+    assert wt_unsel > 0
+    assert wt_sel > 0
+    return np.log((vars_sel+0.5)/(wt_sel+0.5)) - np.log((vars_unsel+0.5)/(wt_unsel+0.5))
+
+
+def frequency(counts):
+    return counts / counts.sum()
+
+
+def log_enrichment(sel, unsel):
+    return np.log(sel) - np.log(unsel)
+
+
+def ebind(bind_p, disp_p):
+    return np.log10(bind_p) - np.log10(disp_p)
+
+
+def edisp(disp_p, bind_p, us_p):
+    return np.log10(0.4*disp_p + 0.6*bind_p) - np.log10(us_p)
+
+
+def replicate_mean(*replicates):
+    return np.mean(replicates, axis=0)
+
+
+# derived columns in the order they are computed: (column, input columns, function, WT reference).
+# Columns with a WT reference are shifted so the max or median of the WT designs (num_mut == 0) is 0
+DERIVED_COLUMNS = [
+    ('us_1p', ['us_1'], frequency, None),
+    ('disp_1p', ['disp_1'], frequency, None),
+    ('bind_1p', ['bind_1'], frequency, None),
+    ('us_2p', ['us_2'], frequency, None),
+    ('disp_2p', ['disp_2'], frequency, None),
+    ('bind_2p', ['bind_2'], frequency, None),
+    ('high_e', ['high_0', 'us_0'], log_enrichment, 'max'),
+    ('low_e', ['low_0', 'us_0'], log_enrichment, 'max'),
+    ('wteq_e', ['wteq_0', 'us_0'], log_enrichment, 'max'),
+    ('disp_0e', ['disp_0', 'us_0'], log_enrichment, 'max'),
+    ('ebind1', ['bind_1p', 'disp_1p'], ebind, 'median'),
+    ('edisp1', ['disp_1p', 'bind_1p', 'us_1p'], edisp, 'median'),
+    ('ebind2', ['bind_2p', 'disp_2p'], ebind, 'median'),
+    ('edisp2', ['disp_2p', 'bind_2p', 'us_2p'], edisp, 'median'),
+    ('ebind', ['ebind1', 'ebind2'], replicate_mean, None),
+    ('edisp', ['edisp1', 'edisp2'], replicate_mean, None),
+]
+
+
+class EnrichmentTable:
+    '''
+    Scores of the design library computed from a designs_counts table as whole-column NumPy operations.
+    Every derived column records the columns it is computed from, so when count columns are updated
+    (e.g. a resequenced sort) only the sorts and derived columns that depend on them are recomputed.
+    Changing a sort in FILTER_SORTS changes which designs pass the read cut, so it rebuilds the table.
+    '''
+
+    def __init__(self, counts_df, sort_columns=SORT_COLUMNS, derived_columns=DERIVED_COLUMNS,
+                 read_cut=READ_CUT, filter_sorts=FILTER_SORTS, pseudocount=PSEUDOCOUNT):
+        '''
+        Args:
+            counts_df: designs_counts table with one row per design, num_mut and the *_count columns
+            sort_columns: dict from sort name to the count columns summed into it
+            derived_columns: list of (column, inputs, function, WT reference), see DERIVED_COLUMNS
+            read_cut: designs with at most read_cut reads in any filter sort are dropped
+            filter_sorts: sorts the read cut is applied to
+            pseudocount: added to every sort after filtering
+        '''
+        self.designs = counts_df[[col for col in counts_df.columns if 'count' not in col]]
+        self.counts = {col: counts_df[col].to_numpy() for col in counts_df.columns if 'count' in col}
+        self.sort_columns = dict(sort_columns)
+        self.derived_columns = list(derived_columns)
+        self.read_cut = read_cut
+        self.filter_sorts = list(filter_sorts)
+        self.pseudocount = pseudocount
+        self.rebuild()
+
+    def rebuild(self):
+        '''
+        Apply the read cut and compute every sort and derived column
+        '''
+        keep = np.ones(len(self.designs), dtype=bool)
+        for sort in self.filter_sorts:
+            keep &= self._sort_counts(sort) > self.read_cut
+        self.keep = keep
+        self.wt = self.designs['num_mut'].to_numpy()[keep] == 0
+        self.values = {}
+        for sort in self.sort_columns:
+            self._compute_sort(sort)
+        for spec in self.derived_columns:
+            self._compute_derived(spec)
+
+    def _sort_counts(self, sort):
+        return sum(self.counts[col] for col in self.sort_columns[sort])
+
+    def _compute_sort(self, sort):
+        self.values[sort] = self._sort_counts(sort)[self.keep] + self.pseudocount
+
+    def _compute_derived(self, spec):
+        column, inputs, function, wt_reference = spec
+        values = function(*[self.values[col] for col in inputs])
+        if wt_reference == 'max':
+            values = values - np.max(values[self.wt])
+        elif wt_reference == 'median':
+            values = values - np.median(values[self.wt])
+        self.values[column] = values
+
+    def dependents(self, columns):
+        '''
+        Find every derived column computed directly or indirectly from the given columns
+        Args:
+            columns: sort or derived column names
+        Returns:
+            list of affected derived columns, in computation order
+        '''
+        changed = set(columns)
+        affected = []
+        for column, inputs, _, _ in self.derived_columns:
+            if changed.intersection(inputs):
+                changed.add(column)
+                affected.append(column)
+        return affected
+
+    def update_counts(self, counts):
+        '''
+        Replace or add count columns and recompute the columns that depend on them
+        Args:
+            counts: DataFrame or dict of count columns, one value per design in the original row order
+        Returns:
+            list of recomputed sort and derived columns
+        '''
+        for col in counts:
+            self.counts[col] = np.asarray(counts[col])
+        sorts = [sort for sort, cols in self.sort_columns.items() if any(col in counts for col in cols)]
+        if any(sort in self.filter_sorts for sort in sorts):
+            self.rebuild()
+            return list(self.values)
+        return self._recompute(sorts)
+
+    def add_sort(self, sort, count_columns, counts=None):
+        '''
+        Add a sort made of count columns, e.g. a new experiment
+        Args:
+            sort: name of the sort column
+            count_columns: count columns summed into the sort
+            counts: DataFrame or dict with the count columns if they are not in the table yet
+        Returns:
+            list of recomputed sort and derived columns
+        '''
+        for col in (counts if counts is not None else []):
+            self.counts[col] = np.asarray(counts[col])
+        self.sort_columns[sort] = list(count_columns)
+        if sort in self.filter_sorts:
+            self.rebuild()
+            return list(self.values)
+        return self._recompute([sort])
+
+    def add_derived(self, column, inputs, function, wt_reference=None):
+        '''
+        Add a derived column, e.g. the enrichment of a new sort, and compute it
+        Args:
+            column: name of the new column
+            inputs: sort or derived columns passed to function
+            function: maps the input arrays to the new column
+            wt_reference: None, 'max' or 'median' of the WT designs to subtract
+        '''
+        spec = (column, list(inputs), function, wt_reference)
+        self.derived_columns = [existing for existing in self.derived_columns if existing[0] != column] + [spec]
+        self._compute_derived(spec)
+
+    def _recompute(self, sorts):
+        for sort in sorts:
+            self._compute_sort(sort)
+        affected = self.dependents(sorts)
+        for spec in self.derived_columns:
+            if spec[0] in affected:
+                self._compute_derived(spec)
+        return list(sorts) + affected
+
+    def to_frame(self):
+        '''
+        Returns:
+            DataFrame with the design columns of the designs that pass the read cut, followed by the sort
+            and derived columns, in the layout of designs_scores.csv
+        '''
+        df = self.designs[self.keep].copy()
+        for column, values in self.values.items():
+            df[column] = values
+        return df
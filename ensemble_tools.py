@@ -0,0 +1,150 @@
+"""Load a family of pretrained nn4dms models into a single graph and run them together."""
+
+from os import listdir
+from os.path import exists, join
+
+import numpy as np
+
+from instrumentation import METRICS
+from prediction_cache import file_hash
+
+
+# tensor names used by nn4dms inference.run_inference / inference_lr.run_inference_lr
+INPUT_NODE = 'raw_seqs_placeholder'
+TRAINING_NODE = 'training_ph'
+OUTPUT_TENSOR = 'output/BiasAdd:0'
+
+
+def find_model_paths(models_dir, num_models=100):
+    '''
+    Find the frozen graph (.pb) of each member of a model family, e.g. pretrained_models/cnns
+    Args:
+        models_dir: directory containing model_0 ... model_{num_models - 1}
+        num_models: number of members in the family
+    Returns:
+        list of paths to the .pb files of the members that were found
+    '''
+    found_models = []
+    model_paths = []
+    for i in range(num_models):
+        path = join(models_dir, 'model_'+str(i))
+        if (exists(path)):
+            for file_name in listdir(path):
+                if '.pb' in file_name:
+                    model_paths.append(path+'/'+file_name)
+                    found_models.append(i)
+    if len(model_paths) != num_models:
+        print('Could not find all models, missing models: ',
+                ','.join([str(i) for i in range(num_models) if i not in found_models]))
+    return model_paths
+
+
+class EnsembleEvaluator:
+    '''
+    Imports every member of a model family into one TensorFlow graph that shares a single input
+    placeholder, so a batch of encoded variants is fed once and all members are evaluated in the same
+    session call. Works for LR models (no training placeholder) and the FCN, CNN and GCN models.
+    The graphs are loaded on the first prediction, so fully cached runs never load them.
+    '''
+
+    def __init__(self, model_paths, chunk_size=4096):
+        '''
+        Args:
+            model_paths: list of paths to frozen member graphs, see find_model_paths
+            chunk_size: maximum number of variants fed per session call
+        '''
+        self.model_paths = list(model_paths)
+        self.chunk_size = chunk_size
+        self.sess = None
+        self._model_id = None
+
+    def _load(self):
+        import tensorflow as tf
+
+        graph_defs = []
+        for model_path in self.model_paths:
+            with tf.gfile.GFile(model_path, 'rb') as f:
+                graph_def = tf.GraphDef()
+                graph_def.ParseFromString(f.read())
+            graph_defs.append(graph_def)
+
+        input_node = [node for node in graph_defs[0].node if node.name == INPUT_NODE][0]
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.raw_seqs_ph = tf.placeholder(tf.as_dtype(input_node.attr['dtype'].type),
+                                              shape=tf.TensorShape(input_node.attr['shape'].shape), name=INPUT_NODE)
+            training = tf.constant(False, name=TRAINING_NODE)
+            member_outputs = []
+            for i, graph_def in enumerate(graph_defs):
+                input_map = {INPUT_NODE + ':0': self.raw_seqs_ph}
+                if any(node.name == TRAINING_NODE for node in graph_def.node):
+                    input_map[TRAINING_NODE + ':0'] = training
+                output, = tf.import_graph_def(graph_def, input_map=input_map, return_elements=[OUTPUT_TENSOR],
+                                              name='member_'+str(i))
+                member_outputs.append(tf.reshape(output, [-1]))
+            self.predictions = tf.stack(member_outputs, axis=1)
+        self.sess = tf.Session(graph=self.graph)
+
+    def __len__(self):
+        return len(self.model_paths)
+
+    @property
+    def model_id(self):
+        '''
+        Identifier of the family for the prediction cache, a hash of the member graphs
+        '''
+        if self._model_id is None:
+            self._model_id = file_hash(self.model_paths)
+        return self._model_id
+
+    def predict(self, encoded_data):
+        '''
+        Score a batch of encoded variants with every member of the family
+        Args:
+            encoded_data: encoded variants, e.g. from enc.encode(encoding="one_hot,aa_index", ...)
+        Returns:
+            array of shape (num_variants, num_members)
+        '''
+        if self.sess is None:
+            with METRICS.timer('ensemble_load', len(self.model_paths)):
+                self._load()
+        with METRICS.timer('ensemble_inference', len(encoded_data)):
+            chunks = [self.sess.run(self.predictions, feed_dict={self.raw_seqs_ph: encoded_data[i:i + self.chunk_size]})
+                      for i in range(0, len(encoded_data), self.chunk_size)]
+        if not chunks:
+            return np.empty((0, len(self)), dtype=np.float32)
+        return np.concatenate(chunks, axis=0)
+
+    def predict_cached(self, seqs, encoded_data, cache=None):
+        '''
+        Score a batch of variants, serving predictions from the prediction cache where possible
+        Args:
+            seqs: list of variant sequences, used as cache keys
+            encoded_data: encoded variants, one row per sequence
+            cache: PredictionCache, None to always run the models
+        Returns:
+            array of shape (num_variants, num_members)
+        '''
+        if cache is None:
+            return self.predict(encoded_data)
+        rows = {seq: i for i, seq in enumerate(seqs)}
+        return cache.predict(self.model_id, seqs, lambda missing: self.predict(encoded_data[[rows[seq] for seq in missing]]))
+
+    def close(self):
+        if self.sess is not None:
+            self.sess.close()
+
+
+def ensc_ensm(pred_all):
+    '''
+    Compute the EnsC and EnsM ensemble predictions without sorting every row
+    Args:
+        pred_all: array (num_variants, num_members) of member predictions
+    Returns:
+        ensc: prediction at index 5 of each row's sorted member predictions
+        ensm: median member prediction of each row
+    '''
+    pred_all = np.asarray(pred_all)
+    ensc = np.partition(pred_all, 5, axis=1)[:, 5]
+    ensm = np.median(pred_all, axis=1)
+    return ensc, ensm
@@ -1,30 +1,31 @@
 """Download SRA sequencing data for project PRJNA1117877."""
 
 # imports
-import subprocess
-import shutil
-import os
+import argparse
+import sys
+from os.path import abspath, dirname
 from tqdm import tqdm
 
 import pandas as pd
 
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+from sra_tools import fetch_runs, DOWNLOAD_COMMAND
 
-output_dir = '.'
-run_info_file = 'PRJNA1117877_run_info.csv'
 
-run_info = pd.read_csv(run_info_file)
+parser = argparse.ArgumentParser()
+parser.add_argument('--output_dir', default='.')
+parser.add_argument('--run_info_file', default='PRJNA1117877_run_info.csv')
+parser.add_argument('--workers', type=int, default=4, help='number of downloads running at the same time')
+parser.add_argument('--retries', type=int, default=3, help='retries of a failed download')
+parser.add_argument('--downloader', default=DOWNLOAD_COMMAND,
+                    help='download command, formatted with {run}, {name} and {outdir}')
+args = parser.parse_args()
 
-# download fastq files from the SRA
-print('Downloading files from SRA...')
-for index, row in tqdm(run_info.iterrows(), total=len(run_info), ncols=100, desc='Progress'):
-    subprocess.run(
-        f'fasterq-dump {row.Run} --outfile {row.LibraryName} --outdir {output_dir}',
-        shell=True,
-        check=True
-    )
-
-    # rename output file to use R1 and R2 to indicate read direction
-    file_base = os.path.join(output_dir, row.LibraryName)
+run_info = pd.read_csv(args.run_info_file)
 
-    for r in [1, 2]:
-        shutil.move(f'{file_base}_{r}.fastq', f'{file_base}_R{r}.fastq')
\ No newline at end of file
+# download fastq files from the SRA, files are saved as <LibraryName>_R1.fastq and <LibraryName>_R2.fastq
+print('Downloading files from SRA...')
+runs = list(zip(run_info.Run, run_info.LibraryName))
+for _ in tqdm(fetch_runs(runs, args.output_dir, args.downloader, args.workers, args.retries),
+              total=len(runs), ncols=100, desc='Progress'):
+    pass
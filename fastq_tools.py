@@ -0,0 +1,462 @@
+"""Streaming FASTQ parsing and batched read-pair merging for GB1 amplicon sequencing."""
+
+import gzip
+import io
+import mmap
+import os
+
+import numpy as np
+
+from instrumentation import METRICS
+
+
+# layout of the paired-end amplicon: the reverse read (R2) covers positions 0-150 of the
+# merged sequence, the reverse complemented forward read (R1) covers positions 119-269
+READ_LENGTH = 151
+OVERLAP_START = 119
+MERGED_LENGTH = 270
+
+# magic bytes used to detect compressed FASTQ files
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+READ_BUFFER_SIZE = 1 << 20
+
+# lookup table for taking the complement of a read, invalid bases map to 0
+COMPLEMENT_LUT = np.zeros(256, dtype=np.uint8)
+for base, comp in zip(b'ACGTN', b'TGCAN'):
+    COMPLEMENT_LUT[base] = comp
+
+
+def get_read_data(all_data):
+    '''
+    Given a line from an NGS file, return the name, sequence, and quality scores of the read
+    Args:
+        all_data: string containing name, read, +, quality
+    Returns:
+        name: identifier for the read
+        read: DNA sequences read
+        quality: quality scores corresponding to each position in the read
+    '''
+
+    all_data = all_data.split('\n')
+    name = all_data[0]
+    try:
+        read = all_data[1]
+    except:
+        print(all_data)
+    quality = all_data[3]
+    return name, read, quality
+
+
+def process_read_pair(fwd_all_data, rev_all_data):
+    '''
+    Take a pair of reads (including their metadata), align them and return a compiled read
+    Args:
+        fwd_all_data: raw string contain name, read, +, quality for the forward read
+        rev_all_data: raw string contain name, read, +, quality for the reverse read
+    Returns:
+        A processed read: aligned reads, select nucleotide with highest quality score for each position
+    '''
+
+    fwd_name, fwd_read, fwd_quality = get_read_data(fwd_all_data)
+    rev_name, rev_read, rev_quality = get_read_data(rev_all_data)
+    complement = {'C':'G', 'G':'C', 'A':'T', 'T':'A', 'N':'N'}
+    if len(fwd_read) != len(fwd_quality) or len(rev_read) != len(rev_quality):
+        print('read and quality score lengths not the same!')
+    # take reverse complement
+    fwd_read = ''.join([complement[fwd_read[len(fwd_read) - i - 1]] for i in range(len(fwd_read))])
+    # convert quality scores to int
+    rev_quality = [ord(q) - 33 for q in rev_quality]
+    fwd_quality = [ord(fwd_quality[len(fwd_quality) - i - 1]) - 33 for i in range(len(fwd_quality))]
+    # merge reads
+    sequence = [None]*270
+    for i in range(270):
+        if i < 151:
+            base = rev_read[i]
+        if i >= 151 or (i >= 119 and i < 151 and rev_quality[i] < fwd_quality[i-119]):
+            base = fwd_read[i-119]
+        sequence[i] = base
+    return ''.join(sequence)
+
+
+def iter_fastq_records(handle):
+    '''
+    Iterate over the 4-line records of a FASTQ file
+    Args:
+        handle: FASTQ file opened in binary mode (or any iterable of byte lines)
+    Returns:
+        generator of (name, read, quality) byte strings with newlines stripped
+    '''
+    lines = iter(handle)
+    for name in lines:
+        try:
+            read = next(lines)
+            plus = next(lines)
+            quality = next(lines)
+        except StopIteration:
+            raise ValueError('truncated FASTQ record: ' + name.decode(errors='replace').rstrip())
+        if name[:1] != b'@' or plus[:1] != b'+':
+            raise ValueError('malformed FASTQ record: ' + name.decode(errors='replace').rstrip())
+        yield name.rstrip(b'\n'), read.rstrip(b'\n'), quality.rstrip(b'\n')
+
+
+def iter_read_pair_batches(fwd_records, rev_records, batch_size=10000):
+    '''
+    Group paired FASTQ records into batches for merging
+    Args:
+        fwd_records: iterable of (name, read, quality) records from the R1 file
+        rev_records: iterable of (name, read, quality) records from the R2 file
+        batch_size: number of read pairs per batch
+    Returns:
+        generator of (fwd_batch, rev_batch) lists of records
+    '''
+    fwd_records = iter(fwd_records)
+    rev_records = iter(rev_records)
+    fwd_batch = []
+    rev_batch = []
+    for fwd_record in fwd_records:
+        rev_record = next(rev_records, None)
+        if rev_record is None:
+            raise ValueError('R1 file has more records than R2 file')
+        fwd_batch.append(fwd_record)
+        rev_batch.append(rev_record)
+        if len(fwd_batch) == batch_size:
+            yield fwd_batch, rev_batch
+            fwd_batch = []
+            rev_batch = []
+    if next(rev_records, None) is not None:
+        raise ValueError('R2 file has more records than R1 file')
+    if fwd_batch:
+        yield fwd_batch, rev_batch
+
+
+def _record_to_string(record):
+    name, read, quality = record
+    return b'\n'.join([name, read, b'+', quality]).decode()
+
+
+def merge_read_pair_batch(fwd_batch, rev_batch):
+    '''
+    Merge a batch of read pairs, equivalent to calling process_read_pair on each pair
+    Args:
+        fwd_batch: list of (name, read, quality) records from the R1 file
+        rev_batch: list of (name, read, quality) records from the R2 file
+    Returns:
+        uint8 array of shape (num_pairs, MERGED_LENGTH) holding the merged reads as ASCII
+    '''
+    num_pairs = len(fwd_batch)
+    # only the last READ_LENGTH bases of R1 and first READ_LENGTH bases of R2 end up in the merged read
+    fwd_reads = np.empty((num_pairs, READ_LENGTH), dtype=np.uint8)
+    fwd_quals = np.empty((num_pairs, READ_LENGTH), dtype=np.uint8)
+    rev_reads = np.empty((num_pairs, READ_LENGTH), dtype=np.uint8)
+    rev_quals = np.empty((num_pairs, READ_LENGTH), dtype=np.uint8)
+    fast = np.ones(num_pairs, dtype=bool)
+    for i, ((_, f_read, f_qual), (_, r_read, r_qual)) in enumerate(zip(fwd_batch, rev_batch)):
+        if (len(f_read) != len(f_qual) or len(r_read) != len(r_qual)
+                or len(f_read) < READ_LENGTH or len(r_read) < READ_LENGTH):
+            fast[i] = False
+            continue
+        fwd_reads[i] = np.frombuffer(f_read, dtype=np.uint8, count=READ_LENGTH, offset=len(f_read) - READ_LENGTH)
+        fwd_quals[i] = np.frombuffer(f_qual, dtype=np.uint8, count=READ_LENGTH, offset=len(f_qual) - READ_LENGTH)
+        rev_reads[i] = np.frombuffer(r_read, dtype=np.uint8, count=READ_LENGTH)
+        rev_quals[i] = np.frombuffer(r_qual, dtype=np.uint8, count=READ_LENGTH)
+
+    # reverse complement R1, reads with bases outside ACGTN are left to process_read_pair
+    fwd_reads = COMPLEMENT_LUT[fwd_reads[:, ::-1]]
+    fwd_quals = fwd_quals[:, ::-1]
+    fast &= (fwd_reads != 0).all(axis=1)
+
+    # select the base with the higher quality score in the overlap, ties go to R2
+    merged = np.empty((num_pairs, MERGED_LENGTH), dtype=np.uint8)
+    overlap = READ_LENGTH - OVERLAP_START
+    merged[:, :OVERLAP_START] = rev_reads[:, :OVERLAP_START]
+    merged[:, OVERLAP_START:READ_LENGTH] = np.where(
+        rev_quals[:, OVERLAP_START:] < fwd_quals[:, :overlap],
+        fwd_reads[:, :overlap], rev_reads[:, OVERLAP_START:])
+    merged[:, READ_LENGTH:] = fwd_reads[:, overlap:MERGED_LENGTH - OVERLAP_START]
+
+    # irregular reads go through the reference implementation so errors and output match exactly
+    irregular = np.flatnonzero(~fast)
+    if len(irregular):
+        with METRICS.timer('process_read_pair', len(irregular)):
+            for i in irregular:
+                sequence = process_read_pair(_record_to_string(fwd_batch[i]), _record_to_string(rev_batch[i]))
+                merged[i] = np.frombuffer(sequence.encode(), dtype=np.uint8)
+    return merged
+
+
+def merged_batch_to_bytes(merged):
+    '''
+    Convert a batch of merged reads to newline-terminated bytes for the merged reads file
+    Args:
+        merged: uint8 array of shape (num_pairs, MERGED_LENGTH)
+    Returns:
+        bytes with one merged read per line
+    '''
+    lines = np.empty((merged.shape[0], merged.shape[1] + 1), dtype=np.uint8)
+    lines[:, :-1] = merged
+    lines[:, -1] = ord('\n')
+    return lines.tobytes()
+
+
+def fastq_num_chunks(file_name, records_per_chunk, sample_records=1000):
+    '''
+    Estimate how many chunks of records_per_chunk records a FASTQ file splits into, from the size of its
+    first records, without reading the rest of the file
+    Args:
+        file_name: path to an uncompressed FASTQ file
+        records_per_chunk: number of 4-line records per chunk
+        sample_records: number of records the record size is estimated from
+    Returns:
+        number of chunks, at least 1
+    '''
+    with open(file_name, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        sample_size = 0
+        sample_lines = 0
+        for line in f:
+            sample_size += len(line)
+            sample_lines += 1
+            if sample_lines == 4 * sample_records:
+                break
+    if sample_lines < 4:
+        return 1
+    num_records = size / (sample_size / (sample_lines // 4))
+    return max(1, int(round(num_records / records_per_chunk)))
+
+
+def _is_record_start(lines, i):
+    # a header line, followed by a read, a '+' line and a quality string of the same length
+    return (lines[i][:1] == b'@' and lines[i + 2][:1] == b'+'
+            and len(lines[i + 1]) == len(lines[i + 3]))
+
+
+def find_record_start(f, offset, window=1 << 16):
+    '''
+    Find the first FASTQ record that starts at or after a byte offset. A quality string can start with
+    '@', so a record is only accepted where the '+' line and the lengths of the following lines fit
+    Args:
+        f: uncompressed FASTQ file opened in binary mode
+        offset: byte offset, e.g. a fraction of the file size
+        window: number of bytes read at a time
+    Returns:
+        byte offset of the record, the file size if no record starts after offset
+    '''
+    size = os.fstat(f.fileno()).st_size
+    if offset <= 0:
+        return 0
+    while True:
+        # reading from offset - 1 tells whether offset itself is the start of a line
+        f.seek(offset - 1)
+        data = f.read(window)
+        at_end = offset - 1 + len(data) >= size
+        first_line = data.find(b'\n') + 1
+        if first_line == 0:
+            if at_end:
+                return size
+            window *= 2
+            continue
+        lines = data[first_line:].split(b'\n')
+        if not at_end:
+            # the last line may be cut off by the window
+            lines.pop()
+        position = offset - 1 + first_line
+        for i in range(len(lines) - 3):
+            if _is_record_start(lines, i):
+                return position
+            position += len(lines[i]) + 1
+        if at_end:
+            return size
+        window *= 2
+
+
+def read_id(name):
+    '''
+    Read id shared by the two records of a pair, the first word of the header without a /1 or /2 suffix
+    Args:
+        name: header line, e.g. b'@SRR1.1 1 length=151' or b'@M00:1:A:1:1101:15589:1331/1'
+    '''
+    words = name.split()
+    name = words[0] if words else name
+    if name[-2:] in (b'/1', b'/2'):
+        name = name[:-2]
+    return name
+
+
+def find_mate_start(f, mate_id, guess, window=1 << 16):
+    '''
+    Find the record with a given read id near an estimated byte offset, searching a range around the
+    estimate that doubles until the record is found
+    Args:
+        f: uncompressed FASTQ file opened in binary mode
+        mate_id: read id of the record, see read_id
+        guess: estimated byte offset of the record
+        window: bytes searched on each side of guess at first
+    Returns:
+        byte offset of the record
+    Raises:
+        ValueError if no record has the read id
+    '''
+    size = os.fstat(f.fileno()).st_size
+    while True:
+        low, high = max(0, guess - window), min(size, guess + window)
+        position = find_record_start(f, low)
+        f.seek(position)
+        while position < high:
+            name = f.readline()
+            if not name:
+                break
+            if read_id(name) == mate_id:
+                return position
+            position += len(name) + sum(len(f.readline()) for _ in range(3))
+        if low == 0 and high == size:
+            raise ValueError('no record with read id ' + mate_id.decode(errors='replace'))
+        window *= 2
+
+
+def fastq_pair_chunk(fwd_file, rev_file, chunk, num_chunks):
+    '''
+    Byte ranges of one chunk of an R1/R2 file pair, found without reading the files in full. R1 is split
+    at equal byte offsets moved to the next record, and R2 at the mate of that record, so both
+    ranges hold the same read pairs. Neighboring chunks compute their shared boundary the same way
+    Args:
+        fwd_file, rev_file: paths to the uncompressed R1 and R2 FASTQ files
+        chunk: index of the chunk
+        num_chunks: number of chunks the pair is split into, e.g. from fastq_num_chunks
+    Returns:
+        fwd_range, rev_range: (start, end) byte ranges, end is None for the end of the file
+    '''
+    if num_chunks == 1:
+        return (0, None), (0, None)
+    with open(fwd_file, 'rb') as fwd, open(rev_file, 'rb') as rev:
+        fwd_size = os.fstat(fwd.fileno()).st_size
+        rev_size = os.fstat(rev.fileno()).st_size
+
+        def boundary(index):
+            if index == 0:
+                return 0, 0
+            if index == num_chunks:
+                return fwd_size, rev_size
+            fwd_offset = find_record_start(fwd, fwd_size * index // num_chunks)
+            if fwd_offset == fwd_size:
+                return fwd_size, rev_size
+            fwd.seek(fwd_offset)
+            mate_id = read_id(fwd.readline())
+            return fwd_offset, find_mate_start(rev, mate_id, fwd_offset * rev_size // fwd_size)
+
+        (fwd_start, rev_start), (fwd_end, rev_end) = boundary(chunk), boundary(chunk + 1)
+    return (fwd_start, fwd_end), (rev_start, rev_end)
+
+
+def resolve_fastq_path(file_name):
+    '''
+    Find a FASTQ file on disk, falling back to a compressed copy if the uncompressed file is missing
+    Args:
+        file_name: path to a FASTQ file as listed in sra_file_pairs.csv
+    Returns:
+        path to file_name, file_name.gz or file_name.zst, whichever exists first
+    '''
+    for candidate in [file_name, file_name + '.gz', file_name + '.zst']:
+        if os.path.exists(candidate):
+            return candidate
+    raise FileNotFoundError(file_name)
+
+
+def fastq_format(file_name):
+    '''
+    Detect the compression of a FASTQ file from its first bytes
+    Args:
+        file_name: path to a FASTQ file
+    Returns:
+        'gzip', 'zstd' or 'fastq' (uncompressed)
+    '''
+    with open(file_name, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return 'fastq'
+
+
+def open_fastq(file_name):
+    '''
+    Open a FASTQ file for streaming, decompressing gzip or zstd input on the fly
+    Args:
+        file_name: path to a FASTQ file
+    Returns:
+        buffered binary file object yielding the uncompressed FASTQ lines
+    '''
+    file_format = fastq_format(file_name)
+    if file_format == 'gzip':
+        return io.BufferedReader(gzip.open(file_name, 'rb'), buffer_size=READ_BUFFER_SIZE)
+    if file_format == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('reading zstd compressed FASTQ files requires the zstandard package')
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_name, 'rb'), closefd=True)
+        return io.BufferedReader(reader, buffer_size=READ_BUFFER_SIZE)
+    return open(file_name, 'rb', buffering=READ_BUFFER_SIZE)
+
+
+def iter_fastq_mmap(file_name, start=0, end=None):
+    '''
+    Iterate over the records of an uncompressed FASTQ file through a memory map, without copying reads
+    Args:
+        file_name: path to an uncompressed FASTQ file
+        start: byte offset of the first record
+        end: byte offset where iteration stops, None to read to the end of the file
+    Returns:
+        generator of (name, read, quality) memoryviews into the file with newlines stripped
+    '''
+    with open(file_name, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size if end is None else end
+        if start >= end:
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    try:
+        position = start
+        while position < end:
+            line_starts = [position]
+            line_ends = []
+            for _ in range(4):
+                if line_starts[-1] >= size:
+                    raise ValueError('truncated FASTQ record: ' + bytes(view[position:line_ends[0]]).decode(errors='replace'))
+                line_end = mm.find(b'\n', line_starts[-1])
+                line_end = size if line_end < 0 else line_end
+                line_ends.append(line_end)
+                line_starts.append(line_end + 1)
+            if view[line_starts[0]] != ord('@') or view[line_starts[2]:line_starts[2] + 1] != b'+':
+                raise ValueError('malformed FASTQ record: ' + bytes(view[position:line_ends[0]]).decode(errors='replace'))
+            yield (view[line_starts[0]:line_ends[0]], view[line_starts[1]:line_ends[1]],
+                   view[line_starts[3]:line_ends[3]])
+            position = line_starts[4]
+    finally:
+        view.release()
+        try:
+            mm.close()
+        except BufferError:
+            # records still referenced by the caller, the map is closed once they are released
+            pass
+
+
+def iter_fastq_file(file_name, start=0, end=None):
+    '''
+    Iterate over the records of a FASTQ file, picking the reader from the file format
+    Args:
+        file_name: path to a gzip, zstd or uncompressed FASTQ file
+        start: byte offset of the first record, only supported for uncompressed files
+        end: byte offset where iteration stops, None to read to the end of the file
+    Returns:
+        generator of (name, read, quality) records
+    '''
+    if fastq_format(file_name) == 'fastq':
+        yield from iter_fastq_mmap(file_name, start, end)
+        return
+    if start != 0 or end is not None:
+        raise ValueError('byte ranges are not supported for compressed FASTQ files')
+    with open_fastq(file_name) as f:
+        yield from iter_fastq_records(f)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# ## Keep the pretrained model families loaded and serve predictions over a Unix socket
+# The 01_* scripts and 02_run_sa.py use the server when it is running instead of loading the models
+
+import argparse
+import contextlib
+import importlib
+import signal
+import numpy as np
+from os.path import join
+from os import chdir
+
+from os.path import abspath
+import sys
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--socket', default='gen_data/inference.sock', help='socket file, relative to the repo root')
+parser.add_argument('--models', default='lr,fcn,gcn,cnn', help='comma-separated model families to serve')
+parser.add_argument('--seq2fitness', default='',
+                    help='comma-separated seq2fitness_tools modules to serve, e.g. seq2fitness_tools_lr')
+parser.add_argument('--max_batch', type=int, default=4096, help='sequences after which a batch is closed')
+parser.add_argument('--batch_wait', type=float, default=0.0, help='seconds to wait for more requests per batch')
+args = parser.parse_args()
+
+# for relative paths in nn4dms code to work properly, we need to set the current working
+# directory to the root of the project
+# we also need to add the code folder to the system path for imports to work properly
+print('Setting working directory to nn4dms root.')
+chdir('nn4dms_nn-extrapolate')
+module_path = abspath("code")
+if module_path not in sys.path:
+    sys.path.append(module_path)
+
+# add relative path to write directory (nn-extrapolation)
+nnextrap_root_relpath = ".."
+pretrained_dir = "nn-extrapolation-models/pretrained_models"
+
+import encode as enc
+import inference as inf
+import inference_lr as inf_lr
+
+from ensemble_tools import find_model_paths, EnsembleEvaluator
+from encoding_tools import SequenceEncoder
+from prediction_cache import handler_model_id
+from serving_tools import BatchingModel, InferenceServer
+from instrumentation import METRICS
+
+# per-stage timings are written to gen_data/metrics at exit, set PIPELINE_METRICS=none to switch them off
+METRICS.report_at_exit(join(nnextrap_root_relpath, 'gen_data/metrics/inference_server.json'))
+
+CHARS = ["A", "C", "D", "E", "F", "G", "H", "I", "K", "L",
+         "M", "N", "P", "Q", "R", "S", "T", "V", "W", "Y"]
+WT = "MQYKLILNGKTLKGETTTEAVDAATAEKVFKQYANDNGVDGEWTYDDATKTFTVTE"
+
+seq_encoder = SequenceEncoder(lambda seqs: enc.encode(encoding="one_hot,aa_index", char_seqs=seqs, wt_aa=[aa for aa in WT]),
+                              CHARS, len(WT))
+sessions = contextlib.ExitStack()
+served = {}
+
+# each family is served as its ensemble ('cnn', all members per sequence) and as the individual model
+# used in the paper ('gb1_cnn')
+ind_model_path = join(nnextrap_root_relpath, pretrained_dir, 'other_models/gb1_')
+for model in [model for model in args.models.split(',') if model]:
+    print('loading', model)
+    ensemble = EnsembleEvaluator(find_model_paths(join(nnextrap_root_relpath, pretrained_dir, model+'s')))
+    ensemble.predict(seq_encoder.encode([WT]))
+    served[model] = BatchingModel(lambda seqs, ensemble=ensemble: ensemble.predict(seq_encoder.encode(seqs)),
+                                  ensemble.model_id, args.max_batch, args.batch_wait)
+    sess = sessions.enter_context(inf.restore_sess(ind_model_path + model))
+    # lr requires separate inference to remove ph parameter
+    run_inference = inf_lr.run_inference_lr if model == 'lr' else inf.run_inference
+    served['gb1_' + model] = BatchingModel(
+        lambda seqs, sess=sess, run_inference=run_inference:
+            np.asarray(run_inference(encoded_data=seq_encoder.encode(seqs), sess=sess)).reshape(len(seqs), -1),
+        'gb1_' + model, args.max_batch, args.batch_wait)
+
+# seq2fitness handlers are served under their module name, as used in the SA configs
+for seq2fitness_tools_name in [name for name in args.seq2fitness.split(',') if name]:
+    print('loading', seq2fitness_tools_name)
+    seq2fitness_tools = importlib.__import__(seq2fitness_tools_name)
+    handler = seq2fitness_tools.seq2fitness_handler()
+    # clients key their prediction cache by a hash of the checkpoint the handler restores
+    try:
+        model_id = handler_model_id(seq2fitness_tools_name, handler,
+                                    ind_model_path + seq2fitness_tools_name.replace('seq2fitness_tools_', '', 1))
+    except ValueError as exc:
+        print(exc)
+        model_id = ''
+    served[seq2fitness_tools_name] = BatchingModel(handler.seq2fitness, model_id, args.max_batch, args.batch_wait)
+
+server = InferenceServer(join(nnextrap_root_relpath, args.socket), served)
+print('serving', ', '.join(served), 'on', args.socket)
+# stop cleanly on kill as well as ctrl-c, so the socket file is removed and metrics are written
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    sessions.close()
@@ -0,0 +1,227 @@
+"""Named stage timers and counters with a metrics report written at exit."""
+
+import atexit
+import csv
+import json
+import os
+import resource
+import sys
+import time
+from os.path import dirname
+
+
+# environment variable overriding the report location, set it to 'none' to switch instrumentation off
+METRICS_ENV_VAR = 'PIPELINE_METRICS'
+
+
+class _NullTimer:
+    # shared no-op timer handed out while instrumentation is off
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def count(self, items):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+_END = object()
+
+
+class _Timer:
+
+    def __init__(self, stage, items):
+        self.stage = stage
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stage = self.stage
+        stage[0] += time.perf_counter() - self.start
+        stage[1] += 1
+        stage[2] += self.items
+        return False
+
+    def count(self, items):
+        self.items += items
+
+
+def result_length(args, kwargs, result):
+    # items counter for wrap() that counts the rows of the result
+    return len(result)
+
+
+class Metrics:
+    '''
+    Accumulates wall time, call counts and processed items per named stage, plus plain counters.
+    Timers are meant for batch-level work (a batch of reads, a chunk of variants, a model restore),
+    each one costs about a microsecond. While disabled, timer() returns a shared no-op object and
+    wrap() returns the function unchanged.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.start_time = time.time()
+        self.reset()
+
+    def reset(self):
+        # stage name -> [seconds, calls, items]
+        self.stages = {}
+        self.counters = {}
+
+    def timer(self, name, items=0):
+        '''
+        Time a block of code as one call of a stage
+        Args:
+            name: stage name, e.g. 'merge'
+            items: number of items (reads, sequences) processed by the block, more can be added with count()
+        Returns:
+            context manager
+        '''
+        if not self.enabled:
+            return _NULL_TIMER
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [0.0, 0, 0]
+        return _Timer(stage, items)
+
+    def wrap(self, name, fn, items=None):
+        '''
+        Time every call of a function, e.g. one from the nn4dms code
+        Args:
+            name: stage name
+            fn: function to time
+            items: function mapping (args, kwargs, result) to the number of items processed by a call
+        Returns:
+            timed function, or fn itself while instrumentation is off
+        '''
+        if not self.enabled:
+            return fn
+
+        def timed_fn(*args, **kwargs):
+            with self.timer(name) as timer:
+                result = fn(*args, **kwargs)
+                if items is not None:
+                    timer.count(items(args, kwargs, result))
+            return result
+        return timed_fn
+
+    def timed_iter(self, name, iterable, items=len):
+        '''
+        Time how long an iterable takes to produce each element, e.g. parsing of FASTQ batches
+        Args:
+            name: stage name
+            iterable: iterable to time
+            items: function mapping an element to the number of items in it
+        Returns:
+            generator over the elements of iterable
+        '''
+        iterator = iter(iterable)
+        while True:
+            with self.timer(name) as timer:
+                element = next(iterator, _END)
+                if element is not _END:
+                    timer.count(items(element))
+            if element is _END:
+                return
+            yield element
+
+    def increment(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self, reset=True):
+        '''
+        Take the metrics collected so far, e.g. to send them from a worker process to the parent
+        Args:
+            reset: clear the collected metrics so they are not reported twice
+        Returns:
+            dict that can be passed to merge
+        '''
+        snapshot = {'stages': {name: list(stage) for name, stage in self.stages.items()}, 'counters': dict(self.counters)}
+        if reset:
+            self.reset()
+        return snapshot
+
+    def merge(self, snapshot):
+        '''
+        Add metrics collected by another process
+        Args:
+            snapshot: dict from snapshot
+        '''
+        if not self.enabled or snapshot is None:
+            return
+        for name, (seconds, calls, items) in snapshot['stages'].items():
+            stage = self.stages.setdefault(name, [0.0, 0, 0])
+            stage[0] += seconds
+            stage[1] += calls
+            stage[2] += items
+        for name, value in snapshot['counters'].items():
+            self.increment(name, value)
+
+    def report(self):
+        '''
+        Returns:
+            dict with the wall time of the process, peak resident memory, and seconds, calls, items and
+            items per second of every stage. Stages run in worker processes add up over the workers
+        '''
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        rss_scale = 1 / 1024 ** 2 if sys.platform == 'darwin' else 1 / 1024
+        stages = {}
+        for name, (seconds, calls, items) in sorted(self.stages.items(), key=lambda stage: -stage[1][0]):
+            stages[name] = {'seconds': seconds, 'calls': calls, 'items': items,
+                            'items_per_s': items / seconds if seconds > 0 and items else None}
+        return {'argv': sys.argv, 'wall_time': time.time() - self.start_time,
+                'peak_rss_mb': usage.ru_maxrss * rss_scale, 'peak_rss_children_mb': children.ru_maxrss * rss_scale,
+                'stages': stages, 'counters': dict(self.counters)}
+
+    def write_report(self, path):
+        '''
+        Write the report to a .json file, or to a .csv file with one row per stage and counter
+        Args:
+            path: report file, its directory is created if missing
+        '''
+        report = self.report()
+        if dirname(path):
+            os.makedirs(dirname(path), exist_ok=True)
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['name', 'seconds', 'calls', 'items', 'items_per_s'])
+                writer.writerow(['wall_time', report['wall_time'], '', '', ''])
+                writer.writerow(['peak_rss_mb', '', '', report['peak_rss_mb'], ''])
+                writer.writerow(['peak_rss_children_mb', '', '', report['peak_rss_children_mb'], ''])
+                for name, stage in report['stages'].items():
+                    writer.writerow([name, stage['seconds'], stage['calls'], stage['items'], stage['items_per_s']])
+                for name, value in report['counters'].items():
+                    writer.writerow([name, '', '', value, ''])
+        else:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    def report_at_exit(self, default_path):
+        '''
+        Write the report when the script exits. The PIPELINE_METRICS environment variable overrides the
+        location, PIPELINE_METRICS=none switches instrumentation off
+        Args:
+            default_path: report file used when PIPELINE_METRICS is not set
+        '''
+        path = os.environ.get(METRICS_ENV_VAR, default_path)
+        if path.lower() == 'none':
+            self.enabled = False
+            return
+        self.enabled = True
+        atexit.register(self.write_report, path)
+
+
+# metrics of the current process, shared by the pipeline modules. Instrumentation is on unless
+# PIPELINE_METRICS=none, reports are only written by scripts that call report_at_exit
+METRICS = Metrics(enabled=os.environ.get(METRICS_ENV_VAR, '').lower() != 'none')
@@ -0,0 +1,105 @@
+"""Manifest of processed read pairs so preprocessing only redoes new or changed files."""
+
+import hashlib
+import json
+import os
+from os.path import exists, join
+
+import numpy as np
+
+
+# bytes hashed at the start and end of each file for its fingerprint
+SAMPLE_SIZE = 1 << 20
+
+
+def file_fingerprint(file_name, sample_size=SAMPLE_SIZE):
+    '''
+    Fingerprint a file by its size, modification time and a hash of its first and last sample_size bytes,
+    cheap enough to run on every multi-GB FASTQ file each time preprocessing starts
+    Args:
+        file_name: path to the file
+        sample_size: bytes hashed at each end of the file
+    Returns:
+        dict with size, mtime_ns and sample_sha1
+    '''
+    stat = os.stat(file_name)
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        sha.update(f.read(sample_size))
+        if stat.st_size > sample_size:
+            f.seek(max(sample_size, stat.st_size - sample_size))
+            sha.update(f.read(sample_size))
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sample_sha1': sha.hexdigest()}
+
+
+def design_set_hash(dna_seqs):
+    '''
+    Hash the designed sequences in order, counts are only reusable for the same design table
+    '''
+    sha = hashlib.sha1()
+    for seq in dna_seqs:
+        sha.update(str(seq).encode() + b'\n')
+    return sha.hexdigest()
+
+
+class CountManifest:
+    '''
+    Records, for every processed R1/R2 pair, the fingerprints of its input files, the settings it was
+    counted with, its read statistics and its count vectors (saved as .npz next to the manifest).
+    A pair is reused when its files and settings are unchanged. The manifest is rewritten after each
+    pair finishes, so an interrupted run keeps the pairs it completed.
+    '''
+
+    def __init__(self, directory):
+        '''
+        Args:
+            directory: where manifest.json and the count vectors are kept, created if missing
+        '''
+        self.directory = directory
+        self.manifest_file = join(directory, 'manifest.json')
+        os.makedirs(join(directory, 'counts'), exist_ok=True)
+        self.entries = {}
+        if exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.entries = json.load(f)
+
+    def lookup(self, pair_key, fingerprints, settings, merged_file=None):
+        '''
+        Find saved counts of an unchanged pair
+        Args:
+            pair_key: name of the pair, e.g. the R1 file name
+            fingerprints: list of file_fingerprint of the R1 and R2 files
+            settings: dict of settings that change the counts, e.g. the design set hash and max_mismatches
+            merged_file: merged reads file the run needs, the pair is reprocessed if it is missing
+        Returns:
+            (counts, stats) as returned by count_read_pair_chunk, or None if the pair has to be processed
+        '''
+        entry = self.entries.get(pair_key)
+        if entry is None or entry['fingerprints'] != fingerprints or entry['settings'] != settings:
+            return None
+        counts_file = join(self.directory, entry['counts_file'])
+        if not exists(counts_file) or (merged_file is not None and not exists(merged_file)):
+            return None
+        with np.load(counts_file) as saved:
+            counts = {suffix: saved[suffix] for suffix in saved.files}
+        return counts, entry['stats']
+
+    def store(self, pair_key, fingerprints, settings, counts, stats):
+        '''
+        Save the counts of a processed pair and rewrite the manifest
+        Args:
+            pair_key: name of the pair, e.g. the R1 file name
+            fingerprints: list of file_fingerprint of the R1 and R2 files
+            settings: dict of settings the counts were made with
+            counts: dict of count vectors, see new_count_vectors
+            stats: dict of read statistics, see merge_and_count_read_pairs
+        '''
+        counts_file = join('counts', pair_key + '.npz')
+        np.savez(join(self.directory, counts_file), **counts)
+        self.entries[pair_key] = {'fingerprints': fingerprints, 'settings': settings, 'counts_file': counts_file,
+                                  'stats': {stat: int(value) for stat, value in stats.items()}}
+        # write to a temporary file first so an interrupted write never corrupts the manifest
+        tmp_file = self.manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, self.manifest_file)
@@ -0,0 +1,249 @@
+"""Persistent prediction cache keyed by sequence and model checkpoint."""
+
+import hashlib
+import os
+import sqlite3
+from collections import OrderedDict
+from glob import glob
+
+import numpy as np
+
+from instrumentation import METRICS
+
+
+# environment variable overriding the cache location, set it to 'none' to disable caching
+CACHE_ENV_VAR = 'PREDICTION_CACHE'
+
+
+def file_hash(file_names):
+    '''
+    Hash the contents of one or more files, e.g. the frozen graphs of a model family
+    Args:
+        file_names: path or list of paths
+    Returns:
+        hex sha1 digest of the concatenated file contents
+    '''
+    if isinstance(file_names, str):
+        file_names = [file_names]
+    sha = hashlib.sha1()
+    for file_name in file_names:
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+
+def checkpoint_files(paths):
+    '''
+    List the files of model checkpoints given as files, directories or checkpoint prefixes
+    Args:
+        paths: list of paths, e.g. 'other_models/gb1_lr' for a directory or the prefix of its .index/.data files
+    Returns:
+        sorted list of files
+    '''
+    files = set()
+    for path in paths:
+        if os.path.isfile(path):
+            files.add(path)
+        elif os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                files.update(os.path.join(root, file_name) for file_name in file_names)
+        else:
+            files.update(glob(path + '.*'))
+    return sorted(files)
+
+
+def handler_model_id(name, handler, default_checkpoint=None):
+    '''
+    Identifier of a seq2fitness handler for the prediction cache, a hash of the checkpoint files it
+    restores, so cached fitnesses are dropped when the model is retrained or its path changes
+    Args:
+        name: seq2fitness_tools module name, e.g. 'seq2fitness_tools_lr'
+        handler: seq2fitness_handler instance. Its attributes that name existing files or directories
+            (or lists of them) are taken as its checkpoint
+        default_checkpoint: checkpoint used if the handler has no such attributes, e.g. other_models/gb1_lr
+    Returns:
+        name + ':' + hex digest of the checkpoint files
+    Raises:
+        ValueError if no checkpoint files are found
+    '''
+    paths = []
+    for value in vars(handler).values():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        paths += [path for path in values if isinstance(path, str) and os.path.exists(path)]
+    if not paths and default_checkpoint is not None:
+        paths = [default_checkpoint]
+    files = checkpoint_files(paths)
+    if not files:
+        raise ValueError('no checkpoint files found for ' + name + ', set ' + CACHE_ENV_VAR + '=none to run without the cache')
+    return name + ':' + file_hash(files)
+
+
+class PredictionCache:
+    '''
+    Two-level cache of model predictions: an in-memory LRU in front of a SQLite database on disk.
+    Entries are keyed by (model_id, sequence), where model_id should change whenever the model does,
+    e.g. a hash of its checkpoint files. The database runs in WAL mode so parallel jobs can read and
+    write the same cache file.
+    '''
+
+    def __init__(self, path, max_memory_items=200000, timeout=60):
+        '''
+        Args:
+            path: SQLite database file, created if missing
+            max_memory_items: number of entries kept in the in-memory LRU layer
+            timeout: seconds to wait for a lock held by another process
+        '''
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.timeout = timeout
+        self.memory = OrderedDict()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._connect()
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path, timeout=self.timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS predictions (model_id TEXT, seq TEXT, dtype TEXT, ndim INTEGER, '
+                          'value BLOB, PRIMARY KEY (model_id, seq))')
+        self.conn.commit()
+
+    def __getstate__(self):
+        # sqlite connections cannot be pickled, worker processes reconnect to the same file
+        state = self.__dict__.copy()
+        del state['conn']
+        state['memory'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._connect()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def lookup(self, model_id, seqs):
+        '''
+        Look up cached predictions
+        Args:
+            model_id: identifier of the model
+            seqs: list of sequences
+        Returns:
+            list with the cached prediction of each sequence, None where the sequence is not cached
+        '''
+        values = [None] * len(seqs)
+        disk_lookups = {}
+        for i, seq in enumerate(seqs):
+            value = self.memory.get((model_id, seq))
+            if value is not None:
+                self.memory.move_to_end((model_id, seq))
+                values[i] = value
+                self.stats['memory_hits'] += 1
+            else:
+                disk_lookups.setdefault(seq, []).append(i)
+
+        unique_seqs = list(disk_lookups)
+        for start in range(0, len(unique_seqs), 500):
+            batch = unique_seqs[start:start + 500]
+            rows = self.conn.execute('SELECT seq, dtype, ndim, value FROM predictions WHERE model_id = ? AND seq IN ('
+                                     + ','.join('?' * len(batch)) + ')', [model_id] + batch).fetchall()
+            for seq, dtype, ndim, blob in rows:
+                value = np.frombuffer(blob, dtype=dtype)
+                value = value[0] if ndim == 0 else value
+                self._remember((model_id, seq), value)
+                for i in disk_lookups[seq]:
+                    values[i] = value
+                self.stats['disk_hits'] += len(disk_lookups[seq])
+        self.stats['misses'] += sum(value is None for value in values)
+        return values
+
+    def store(self, model_id, seqs, values):
+        '''
+        Add predictions to the cache
+        Args:
+            model_id: identifier of the model
+            seqs: list of sequences
+            values: predictions, one scalar or 1-D array per sequence
+        '''
+        rows = []
+        for seq, value in zip(seqs, values):
+            value = np.asarray(value)
+            self._remember((model_id, seq), value[()] if value.ndim == 0 else value)
+            rows.append((model_id, seq, value.dtype.str, value.ndim, value.tobytes()))
+        with self.conn:
+            self.conn.executemany('INSERT OR IGNORE INTO predictions VALUES (?, ?, ?, ?, ?)', rows)
+
+    def predict(self, model_id, seqs, score_fn):
+        '''
+        Return predictions for a list of sequences, scoring only the ones that are not cached
+        Args:
+            model_id: identifier of the model
+            seqs: list of sequences
+            score_fn: function mapping a list of uncached sequences to an array of predictions, one row per sequence
+        Returns:
+            array of predictions, one row per sequence
+        '''
+        with METRICS.timer('cache_lookup', len(seqs)):
+            values = self.lookup(model_id, seqs)
+        missing = {}
+        for i, (seq, value) in enumerate(zip(seqs, values)):
+            if value is None:
+                missing.setdefault(seq, []).append(i)
+        if missing:
+            missing_seqs = list(missing)
+            missing_values = score_fn(missing_seqs)
+            with METRICS.timer('cache_store', len(missing_seqs)):
+                self.store(model_id, missing_seqs, missing_values)
+            for seq, value in zip(missing_seqs, missing_values):
+                for i in missing[seq]:
+                    values[i] = value
+        if not values:
+            return np.empty(0)
+        return np.stack(values)
+
+    def wrap(self, model_id, score_fn):
+        '''
+        Put the cache in front of a scoring function such as seq2fitness_handler.seq2fitness
+        Args:
+            model_id: identifier of the model
+            score_fn: function mapping a list of sequences (or a single sequence) to predictions
+        Returns:
+            function with the same call signature as score_fn
+        '''
+        def cached_score_fn(seqs):
+            # a single sequence is passed through to score_fn as is
+            if isinstance(seqs, str):
+                return self.predict(model_id, [seqs], lambda missing: [score_fn(missing[0])])[0]
+            return self.predict(model_id, list(seqs), score_fn)
+        return cached_score_fn
+
+    def report(self):
+        '''
+        Returns:
+            one-line summary of the cache hit/miss statistics
+        '''
+        total = sum(self.stats.values())
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        rate = hits / total if total else 0.0
+        return ('Prediction cache: {} lookups, {} memory hits, {} disk hits, {} misses ({:.1%} hit rate)'
+                .format(total, self.stats['memory_hits'], self.stats['disk_hits'], self.stats['misses'], rate))
+
+    def close(self):
+        self.conn.close()
+
+
+def open_prediction_cache(default_path):
+    '''
+    Open the prediction cache used by the analysis scripts
+    Args:
+        default_path: cache location used when the PREDICTION_CACHE environment variable is not set
+    Returns:
+        PredictionCache, or None if caching is disabled with PREDICTION_CACHE=none
+    '''
+    path = os.environ.get(CACHE_ENV_VAR, default_path)
+    if path.lower() == 'none':
+        return None
+    return PredictionCache(path)
@@ -0,0 +1,50 @@
+"""Binary storage of per-member ensemble predictions next to a small variant index."""
+
+import os
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+
+VARIANT_INDEX_FILE = 'variants.csv'
+
+
+def save_predictions(directory, variants_df, pred_matrices):
+    '''
+    Save a variant table and per-member prediction matrices
+    Args:
+        directory: output directory, created if missing
+        variants_df: DataFrame with one row per variant and scalar columns only
+        pred_matrices: dict from name (e.g. 'cnn_pred_all') to an array (num_variants, num_members)
+    '''
+    os.makedirs(directory, exist_ok=True)
+    for name, matrix in pred_matrices.items():
+        if len(matrix) != len(variants_df):
+            raise ValueError(name + ' does not have one row per variant')
+        np.save(join(directory, name + '.npy'), np.ascontiguousarray(matrix))
+    variants_df.to_csv(join(directory, VARIANT_INDEX_FILE), index=False)
+
+
+def load_variant_index(directory):
+    '''
+    Load the variant table saved by save_predictions
+    Args:
+        directory: directory written by save_predictions
+    Returns:
+        DataFrame with one row per variant, row i matches row i of the prediction matrices
+    '''
+    return pd.read_csv(join(directory, VARIANT_INDEX_FILE))
+
+
+def load_prediction_matrix(directory, name, mmap_mode='r'):
+    '''
+    Load a prediction matrix saved by save_predictions
+    Args:
+        directory: directory written by save_predictions
+        name: matrix name, e.g. 'cnn_pred_all'
+        mmap_mode: numpy memory-map mode, 'r' only reads the rows that are sliced, None loads the whole matrix
+    Returns:
+        array (num_variants, num_members)
+    '''
+    return np.load(join(directory, name + '.npy'), mmap_mode=mmap_mode)
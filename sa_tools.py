@@ -0,0 +1,297 @@
+"""Simulated annealing over many chains with batched fitness evaluation."""
+
+import os
+import pickle
+from os.path import exists
+
+import numpy as np
+
+from instrumentation import METRICS
+
+
+# header of trajectory logs: magic bytes followed by the number of chains as uint64
+TRAJECTORY_MAGIC = b'SATRAJ01'
+TRAJECTORY_HEADER_SIZE = 16
+
+
+class TrajectoryLog:
+    '''
+    Append-only on-disk log of the current fitness of every chain at every step. Rows are buffered
+    and written in chunks of float64 values, so memory stays flat however many steps are run.
+    '''
+
+    def __init__(self, path, n_chains, chunk_rows=1024, resume_rows=None):
+        '''
+        Args:
+            path: log file, overwritten unless resuming
+            n_chains: number of values per row
+            chunk_rows: number of rows buffered before they are written
+            resume_rows: keep the first resume_rows rows of an existing log and append after them,
+                rows written after the last checkpoint are dropped. If there is no log yet, a new one
+                is started with resume_rows rows of nan
+        '''
+        self.path = path
+        self.n_chains = n_chains
+        self.buffer = np.empty((chunk_rows, n_chains), dtype='<f8')
+        self.buffered = 0
+        if resume_rows is None or not exists(path):
+            self.f = open(path, 'wb')
+            self.f.write(TRAJECTORY_MAGIC + np.uint64(n_chains).astype('<u8').tobytes())
+            if resume_rows is not None:
+                # the rows before the resumed step were never logged
+                nan_chunk = np.full((chunk_rows, n_chains), np.nan, dtype='<f8')
+                for start in range(0, resume_rows, chunk_rows):
+                    self.f.write(nan_chunk[:min(chunk_rows, resume_rows - start)].tobytes())
+        else:
+            if read_trajectory_header(path) != n_chains:
+                raise ValueError(path + ' does not match the number of chains')
+            self.f = open(path, 'r+b')
+            self.f.truncate(TRAJECTORY_HEADER_SIZE + resume_rows * n_chains * 8)
+            self.f.seek(0, os.SEEK_END)
+
+    def append(self, row):
+        self.buffer[self.buffered] = row
+        self.buffered += 1
+        if self.buffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.f.write(self.buffer[:self.buffered].tobytes())
+        self.buffered = 0
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def read_trajectory_header(path):
+    with open(path, 'rb') as f:
+        header = f.read(TRAJECTORY_HEADER_SIZE)
+    if len(header) != TRAJECTORY_HEADER_SIZE or header[:8] != TRAJECTORY_MAGIC:
+        raise ValueError(path + ' is not a trajectory log')
+    return int(np.frombuffer(header[8:], dtype='<u8')[0])
+
+
+def load_trajectory(path):
+    '''
+    Memory-map a trajectory log written by TrajectoryLog
+    Args:
+        path: log file
+    Returns:
+        read-only array (num_steps + 1, n_chains) of the current fitness of each chain
+    '''
+    n_chains = read_trajectory_header(path)
+    num_rows = (os.path.getsize(path) - TRAJECTORY_HEADER_SIZE) // (8 * n_chains)
+    if num_rows == 0:
+        return np.empty((0, n_chains))
+    return np.memmap(path, dtype='<f8', mode='r', offset=TRAJECTORY_HEADER_SIZE, shape=(num_rows, n_chains))
+
+
+class MultiChainSA:
+    '''
+    Simulated annealing optimizer that advances many independent chains in lockstep. Every step,
+    each chain proposes a new design and all proposals are scored in a single seq2fitness call, so
+    neural network models see a batch of n_chains sequences instead of one. Each chain draws from
+    its own random state, so a chain run with seed s follows the same trajectory whether it runs
+    alone or next to other chains.
+
+    Designs carry exactly num_mut mutations from WT. A proposal moves max(1, Poisson(mut_rate))
+    of them to new random sites and amino acids allowed by AA_options.
+
+    This is its own optimizer, not a batched design_tools.SA_optimizer, and a chain does not
+    reproduce the SA_optimizer design of the same seed:
+    - the temperature falls from T_max to T_min, which have no defaults and must be given
+    - proposals use the move above rather than SA_optimizer's mutation step
+    - every chain draws from its own numpy RandomState
+    '''
+
+    def __init__(self, seq2fitness, WT, AA_options, num_mut, T_max, T_min, mut_rate=1, nsteps=1000,
+                 cool_sched='log', mut2fitness=None):
+        '''
+        Args:
+            seq2fitness: function mapping a list of sequences to an array of fitnesses
+            WT: wild-type sequence
+            AA_options: allowed amino acids at each position
+            num_mut: number of mutations from WT in every design
+            T_max: starting temperature
+            T_min: final temperature
+            mut_rate: mean number of mutations moved per proposal
+            nsteps: number of annealing steps
+            cool_sched: 'log' (geometric) or 'lin' (linear) cooling from T_max to T_min
+            mut2fitness: optional function scoring a list of designs given as {position: aa} dicts, used
+                instead of seq2fitness, e.g. AdditiveModel.score_muts for linear regression models
+        '''
+        self.seq2fitness = seq2fitness
+        self.mut2fitness = mut2fitness
+        self.WT = WT
+        self.num_mut = num_mut
+        self.mut_rate = mut_rate
+        self.nsteps = nsteps
+        self.cool_sched = cool_sched
+        self.T_max = T_max
+        self.T_min = T_min
+        if cool_sched == 'log':
+            self.temperatures = np.logspace(np.log10(T_max), np.log10(T_min), nsteps)
+        elif cool_sched == 'lin':
+            self.temperatures = np.linspace(T_max, T_min, nsteps)
+        else:
+            raise ValueError('unknown cooling schedule: ' + str(cool_sched))
+        # substitutions allowed at each position, excluding the WT residue
+        self.mut_options = [[aa for aa in options if aa != wt_aa] for wt_aa, options in zip(WT, AA_options)]
+        self.mutable_positions = [pos for pos, options in enumerate(self.mut_options) if options]
+        if len(self.mutable_positions) < num_mut:
+            raise ValueError('fewer mutable positions than num_mut')
+        self.trajectory = None
+        self.trajectory_file = None
+
+    def mut2seq(self, mut):
+        seq = list(self.WT)
+        for pos, aa in mut.items():
+            seq[pos] = aa
+        return ''.join(seq)
+
+    def score(self, muts):
+        if self.mut2fitness is not None:
+            return np.asarray(self.mut2fitness(muts), dtype=float).reshape(-1)
+        return np.asarray(self.seq2fitness([self.mut2seq(mut) for mut in muts]), dtype=float).reshape(-1)
+
+    def mut_names(self, mut):
+        return [self.WT[pos] + str(pos) + mut[pos] for pos in sorted(mut)]
+
+    def random_mut(self, rng):
+        positions = rng.choice(self.mutable_positions, self.num_mut, replace=False)
+        return {int(pos): self.mut_options[pos][rng.randint(len(self.mut_options[pos]))] for pos in positions}
+
+    def propose(self, mut, rng):
+        new_mut = dict(mut)
+        num_moves = min(max(1, rng.poisson(self.mut_rate)), self.num_mut)
+        for _ in range(num_moves):
+            del new_mut[list(new_mut)[rng.randint(len(new_mut))]]
+            free_positions = [pos for pos in self.mutable_positions if pos not in new_mut]
+            pos = free_positions[rng.randint(len(free_positions))]
+            new_mut[pos] = self.mut_options[pos][rng.randint(len(self.mut_options[pos]))]
+        return new_mut
+
+    def settings(self):
+        return {'WT': self.WT, 'num_mut': self.num_mut, 'mut_rate': self.mut_rate, 'nsteps': self.nsteps,
+                'cool_sched': self.cool_sched, 'T_max': self.T_max, 'T_min': self.T_min,
+                'mut_options': self.mut_options}
+
+    def save_checkpoint(self, checkpoint_file, state):
+        # write to a temporary file first so a preempted write never corrupts the last checkpoint
+        tmp_file = checkpoint_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(dict(state, settings=self.settings()), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, checkpoint_file)
+
+    def load_checkpoint(self, checkpoint_file, seeds):
+        with open(checkpoint_file, 'rb') as f:
+            state = pickle.load(f)
+        if state['settings'] != self.settings() or state['seeds'] != list(seeds):
+            raise ValueError(checkpoint_file + ' was written by a run with different settings or seeds')
+        return state
+
+    def optimize(self, seeds, checkpoint_file=None, checkpoint_every=1000, trajectory_file=None, resume=False):
+        '''
+        Run one annealing chain per seed
+        Args:
+            seeds: list of integer seeds, one per chain
+            checkpoint_file: where to save the random states, schedule position and current/best designs
+                of all chains every checkpoint_every steps and at the end of the run
+            checkpoint_every: number of steps between checkpoints
+            trajectory_file: stream the trajectory to this TrajectoryLog instead of keeping it in memory
+            resume: continue from checkpoint_file if it exists, the result is the same as an uninterrupted run
+        Returns:
+            list with (best_mut, fitness) of each chain, best_mut is a list of mutations like 'Q1F'
+        '''
+        seeds = list(seeds)
+        rngs = [np.random.RandomState(seed) for seed in seeds]
+        if resume and checkpoint_file is not None and exists(checkpoint_file):
+            state = self.load_checkpoint(checkpoint_file, seeds)
+            for rng, rng_state in zip(rngs, state['rng_states']):
+                rng.set_state(rng_state)
+            start_step = state['step']
+            current, current_fit = state['current'], state['current_fit']
+            best, best_fit = state['best'], state['best_fit']
+            print('resuming from step', start_step, 'of', self.nsteps)
+        else:
+            start_step = None
+            current = [self.random_mut(rng) for rng in rngs]
+            current_fit = self.score(current)
+            best = list(current)
+            best_fit = current_fit.copy()
+
+        # the trajectory has one row for the starting designs and one per step
+        self.trajectory_file = trajectory_file
+        if trajectory_file is not None:
+            self.trajectory = None
+            trajectory_log = TrajectoryLog(trajectory_file, len(seeds),
+                                           resume_rows=None if start_step is None else start_step + 1)
+        else:
+            trajectory_log = None
+            # rows before a resumed step are not known, they are left as nan
+            self.trajectory = np.full((self.nsteps + 1, len(seeds)), np.nan)
+
+        def record(row_index, fit):
+            if trajectory_log is not None:
+                trajectory_log.append(fit)
+            else:
+                self.trajectory[row_index] = fit
+
+        if start_step is None:
+            start_step = 0
+            record(0, current_fit)
+
+        def checkpoint(step):
+            if trajectory_log is None and checkpoint_file is None:
+                return
+            with METRICS.timer('sa_checkpoint'):
+                if trajectory_log is not None:
+                    trajectory_log.flush()
+                if checkpoint_file is not None:
+                    self.save_checkpoint(checkpoint_file, {
+                        'seeds': seeds, 'step': step, 'rng_states': [rng.get_state() for rng in rngs],
+                        'current': current, 'current_fit': current_fit, 'best': best, 'best_fit': best_fit})
+
+        for step in range(start_step, self.nsteps):
+            temperature = self.temperatures[step]
+            with METRICS.timer('sa_propose', len(rngs)):
+                proposals = [self.propose(mut, rng) for mut, rng in zip(current, rngs)]
+            proposal_fit = self.score(proposals)
+            for chain, rng in enumerate(rngs):
+                delta = proposal_fit[chain] - current_fit[chain]
+                # draw for every chain so the random streams do not depend on acceptance
+                if rng.rand() < np.exp(min(0.0, delta / temperature)):
+                    current[chain] = proposals[chain]
+                    current_fit[chain] = proposal_fit[chain]
+                    if current_fit[chain] > best_fit[chain]:
+                        best[chain] = current[chain]
+                        best_fit[chain] = current_fit[chain]
+            record(step + 1, current_fit)
+            if (step + 1) % checkpoint_every == 0 and step + 1 < self.nsteps:
+                checkpoint(step + 1)
+
+        checkpoint(self.nsteps)
+        if trajectory_log is not None:
+            trajectory_log.close()
+        return [(self.mut_names(mut), fit) for mut, fit in zip(best, best_fit)]
+
+    def plot_trajectory(self, savefig_name=None):
+        import matplotlib.pyplot as plt
+
+        trajectory = self.trajectory if self.trajectory_file is None else load_trajectory(self.trajectory_file)
+        # thin out long trajectories so the plot stays responsive
+        stride = max(1, len(trajectory) // 100000)
+        plt.figure()
+        plt.plot(np.arange(0, len(trajectory), stride), trajectory[::stride])
+        plt.xlabel('Step')
+        plt.ylabel('Fitness')
+        if savefig_name is None:
+            plt.show()
+        else:
+            plt.savefig(savefig_name)
+        plt.close()
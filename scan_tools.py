@@ -0,0 +1,298 @@
+"""Combinatorial site-saturation scans scored chunk by chunk into out-of-core columns."""
+
+import json
+import os
+from os.path import join
+
+import numpy as np
+
+from instrumentation import METRICS
+
+
+SCAN_INFO_FILE = 'scan.json'
+VARIANT_COLUMN = 'variants'
+QUANTILES = [0.001, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999]
+
+
+class SiteSaturationScan:
+    '''
+    Lazily enumerates every combination of chars at a set of positions of wt, in the order of
+    itertools.product(chars, repeat=len(positions)). Variant i is decoded from i as a mixed-radix
+    number, so any range of the library can be built without building the ones before it.
+    '''
+
+    def __init__(self, wt, positions, chars):
+        '''
+        Args:
+            wt: parent sequence
+            positions: list of mutated positions (0-indexed)
+            chars: amino acids tried at every position
+        '''
+        self.wt = wt
+        self.positions = list(positions)
+        self.chars = list(chars)
+        char_index = {aa: i for i, aa in enumerate(self.chars)}
+        self.wt_indices = np.array([char_index[aa] for aa in wt], dtype=np.uint8)
+        self.char_codes = np.frombuffer(''.join(self.chars).encode(), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.chars) ** len(self.positions)
+
+    def codes(self, rows):
+        '''
+        Residue indices of variants at the mutated positions
+        Args:
+            rows: array of variant numbers
+        Returns:
+            uint8 array (num_rows, num_positions)
+        '''
+        rows = np.array(rows, dtype=np.int64)
+        codes = np.empty((len(rows), len(self.positions)), dtype=np.uint8)
+        for column in range(len(self.positions) - 1, -1, -1):
+            codes[:, column] = rows % len(self.chars)
+            rows //= len(self.chars)
+        return codes
+
+    def labels(self, codes):
+        '''
+        Residues at the mutated positions as fixed-width byte strings, e.g. b'VDGV'
+        '''
+        return np.ascontiguousarray(self.char_codes[codes]).view('S' + str(len(self.positions)))[:, 0]
+
+    def iter_chunks(self, chunk_size=10000, start=0):
+        '''
+        Build the variants in fixed-size chunks
+        Args:
+            chunk_size: number of variants per chunk
+            start: first variant
+        Returns:
+            generator of (first variant of the chunk, codes from codes(), uint8 residue indices (n, seq_len)
+            that can be encoded with SequenceEncoder.encode_indices)
+        '''
+        for chunk_start in range(start, len(self), chunk_size):
+            codes = self.codes(np.arange(chunk_start, min(chunk_start + chunk_size, len(self))))
+            indices = np.repeat(self.wt_indices[None], len(codes), axis=0)
+            indices[:, self.positions] = codes
+            yield chunk_start, codes, indices
+
+
+class QuantileSketch:
+    '''
+    Fixed-size histogram for approximate quantiles of a stream of values. When a value falls outside
+    the covered range, neighboring bins are merged in pairs to double the range, so memory stays
+    constant and quantiles are accurate to about one bin width (the value range / num_bins).
+    '''
+
+    def __init__(self, num_bins=1 << 16):
+        self.num_bins = num_bins
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+        self.lo = None
+        self.width = None
+        self.count = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _double(self, shift):
+        # merge bins in pairs, the old bins move to the upper half of the range if shift is set
+        merged = self.counts.reshape(-1, 2).sum(axis=1)
+        self.counts = np.zeros_like(self.counts)
+        offset = self.num_bins // 2 if shift else 0
+        self.counts[offset:offset + len(merged)] = merged
+        self.lo -= offset * 2 * self.width
+        self.width *= 2
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return
+        vmin, vmax = values.min(), values.max()
+        if self.lo is None:
+            self.lo = vmin
+            self.width = max(vmax - vmin, abs(vmin) * 1e-6, 1e-12) / self.num_bins * (1 + 1e-9)
+        while vmin < self.lo:
+            self._double(shift=True)
+        while vmax >= self.lo + self.width * self.num_bins:
+            self._double(shift=False)
+        bins = np.minimum(((values - self.lo) / self.width).astype(np.int64), self.num_bins - 1)
+        self.counts += np.bincount(bins, minlength=self.num_bins)
+        self.count += len(values)
+        self.total += values.sum()
+        self.min = min(self.min, vmin)
+        self.max = max(self.max, vmax)
+
+    def quantile(self, q):
+        '''
+        Args:
+            q: quantile or list of quantiles between 0 and 1
+        Returns:
+            approximate quantiles, interpolated within their bin
+        '''
+        cumulative = np.cumsum(self.counts)
+        targets = np.asarray(q, dtype=np.float64) * self.count
+        bins = np.minimum(np.searchsorted(cumulative, targets, side='left'), self.num_bins - 1)
+        below = np.where(bins > 0, cumulative[bins - 1], 0)
+        fraction = (targets - below) / np.maximum(self.counts[bins], 1)
+        return np.clip(self.lo + (bins + fraction) * self.width, self.min, self.max)
+
+
+class RunningTopK:
+    '''
+    Keeps the k largest values of a stream and the rows they came from.
+    '''
+
+    def __init__(self, k):
+        self.k = k
+        self.values = np.empty(0, dtype=np.float64)
+        self.rows = np.empty(0, dtype=np.int64)
+
+    def update(self, values, first_row):
+        '''
+        Args:
+            values: 1D array of new values
+            first_row: row of values[0] in the full stream
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        keep = np.flatnonzero(np.isfinite(values))
+        if len(self.values) == self.k:
+            # only values above the current k-th largest can enter
+            keep = keep[values[keep] > self.values.min()]
+        values = np.concatenate([self.values, values[keep]])
+        rows = np.concatenate([self.rows, keep + first_row])
+        if len(values) > self.k:
+            top = np.argpartition(-values, self.k - 1)[:self.k]
+            values, rows = values[top], rows[top]
+        self.values, self.rows = values, rows
+
+    def result(self):
+        '''
+        Returns:
+            values and rows sorted from the largest value down
+        '''
+        order = np.argsort(-self.values, kind='stable')
+        return self.values[order], self.rows[order]
+
+
+class ScanStore:
+    '''
+    Writes scan results out of core as one .npy file per column in directory, preallocated to the size
+    of the library and filled chunk by chunk through plain file writes, so the results never build
+    up in process memory. The files load with np.load(mmap_mode='r') or
+    prediction_store.load_prediction_matrix. Every 1D column gets a running top-k and quantile
+    sketch, written with the scan settings to scan.json on close.
+    '''
+
+    def __init__(self, directory, scan, top_k=100, quantiles=QUANTILES):
+        '''
+        Args:
+            directory: output directory, created if missing
+            scan: SiteSaturationScan whose variants are stored
+            top_k: number of best variants kept for each 1D column
+            quantiles: quantiles reported for each 1D column
+        '''
+        self.directory = directory
+        self.scan = scan
+        self.top_k = top_k
+        self.quantiles = list(quantiles)
+        self.files = {}
+        self.row_bytes = {}
+        self.offsets = {}
+        self.sketches = {}
+        self.top = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _create(self, name, values):
+        # write the .npy header for the full column, then keep the file open for chunk writes
+        path = join(self.directory, name + '.npy')
+        column = np.lib.format.open_memmap(path, mode='w+', dtype=values.dtype,
+                                           shape=(len(self.scan),) + values.shape[1:])
+        self.offsets[name] = column.offset
+        del column
+        self.files[name] = open(path, 'r+b')
+        self.row_bytes[name] = values.dtype.itemsize * int(np.prod(values.shape[1:], dtype=np.int64))
+        if values.ndim == 1 and name != VARIANT_COLUMN:
+            self.sketches[name] = QuantileSketch()
+            self.top[name] = RunningTopK(self.top_k)
+
+    def write(self, name, start, values):
+        '''
+        Write the rows of a column from start on
+        Args:
+            name: column name, e.g. 'cnn_ensm'
+            start: first row of values
+            values: array with one row per variant, the same dtype and row shape on every call
+        '''
+        values = np.ascontiguousarray(values)
+        if name not in self.files:
+            self._create(name, values)
+        f = self.files[name]
+        f.seek(self.offsets[name] + start * self.row_bytes[name])
+        f.write(values.tobytes())
+        if name in self.sketches:
+            self.sketches[name].update(values)
+            self.top[name].update(values, start)
+
+    def summary(self):
+        '''
+        Returns:
+            dict from 1D column to its count, mean, min, max, quantiles and top variants
+        '''
+        summary = {}
+        for name, sketch in self.sketches.items():
+            values, rows = self.top[name].result()
+            labels = self.scan.labels(self.scan.codes(rows))
+            summary[name] = {
+                'count': sketch.count, 'mean': sketch.total / sketch.count if sketch.count else None,
+                'min': float(sketch.min), 'max': float(sketch.max),
+                'quantiles': {str(q): float(v) for q, v in zip(self.quantiles, sketch.quantile(self.quantiles))},
+                'top': [{'row': int(row), 'variant': label.decode(), 'value': float(value)}
+                        for row, label, value in zip(rows, labels, values)]}
+        return summary
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        info = {'wt': self.scan.wt, 'positions': self.scan.positions, 'chars': self.scan.chars,
+                'num_variants': len(self.scan), 'columns': sorted(self.row_bytes), 'summary': self.summary()}
+        with open(join(self.directory, SCAN_INFO_FILE), 'w') as f:
+            json.dump(info, f, indent=1)
+
+
+def scan_library(scan, encoder, score_fn, store, chunk_size=10000, progress=None):
+    '''
+    Encode and score every variant of a scan in fixed-size chunks, memory use does not depend on the
+    size of the library. The variant labels are stored with the first scan written to the store
+    Args:
+        scan: SiteSaturationScan
+        encoder: SequenceEncoder built with the chars of the scan
+        score_fn: maps encoded variants (n, seq_len, num_features) to a dict of result columns, each with
+            n rows, e.g. {'cnn_ensm': ..., 'cnn_pred_all': ...}
+        store: ScanStore the columns are written to
+        chunk_size: number of variants per chunk
+        progress: optional function wrapping the chunk iterator, e.g. tqdm
+    '''
+    if encoder.chars != scan.chars:
+        raise ValueError('the encoder and the scan use different amino acid orders')
+    write_variants = VARIANT_COLUMN not in store.row_bytes
+    chunks = scan.iter_chunks(chunk_size)
+    if progress is not None:
+        chunks = progress(chunks, total=-(-len(scan) // chunk_size))
+    for start, codes, indices in chunks:
+        if write_variants:
+            store.write(VARIANT_COLUMN, start, scan.labels(codes))
+        encoded = encoder.encode_indices(indices)
+        with METRICS.timer('scan_score', len(indices)):
+            columns = score_fn(encoded)
+        with METRICS.timer('scan_write', len(indices)):
+            for name, values in columns.items():
+                store.write(name, start, values)
+
+
+def load_scan_info(directory):
+    '''
+    Load the settings and column summaries written by ScanStore.close
+    '''
+    with open(join(directory, SCAN_INFO_FILE)) as f:
+        return json.load(f)
@@ -0,0 +1,303 @@
+"""Local inference server that keeps models loaded, and the client used by the scripts."""
+
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+
+import numpy as np
+
+from instrumentation import METRICS
+
+
+# environment variable overriding the server socket, set it to 'none' to always load the models locally
+SERVER_ENV_VAR = 'INFERENCE_SERVER'
+HEADER_SIZE = struct.Struct('!I')
+
+
+def _recv_exact(sock, num_bytes):
+    buffer = bytearray(num_bytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < num_bytes:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise EOFError('connection closed')
+        received += n
+    return buffer
+
+
+def send_message(sock, header, array=None):
+    '''
+    Send a JSON header, followed by the raw bytes of an array if there is one
+    Args:
+        sock: connected socket
+        header: JSON-serializable dict
+        array: optional numpy array, its dtype and shape are added to the header
+    '''
+    payload = b''
+    if array is not None:
+        array = np.ascontiguousarray(array)
+        header = dict(header, dtype=array.dtype.str, shape=array.shape)
+        payload = array.tobytes()
+    header = json.dumps(dict(header, nbytes=len(payload))).encode()
+    sock.sendall(HEADER_SIZE.pack(len(header)) + header + payload)
+
+
+def recv_message(sock):
+    '''
+    Receive a message sent by send_message
+    Returns:
+        header: dict
+        array: numpy array, or None if the message has no array
+    '''
+    header_size, = HEADER_SIZE.unpack(_recv_exact(sock, HEADER_SIZE.size))
+    header = json.loads(_recv_exact(sock, header_size).decode())
+    payload = _recv_exact(sock, header['nbytes']) if header['nbytes'] else None
+    if 'dtype' not in header:
+        return header, None
+    return header, np.frombuffer(payload or b'', dtype=header['dtype']).reshape(header['shape'])
+
+
+class _Request:
+
+    def __init__(self, seqs):
+        self.seqs = seqs
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchingModel:
+    '''
+    Runs a scoring function in a dedicated thread and groups concurrent requests into one call.
+    Requests that arrive while a batch is being scored are scored together in the next one, so a
+    single client pays no batching delay and many clients get large batches. batch_wait adds a
+    wait for more requests after the first one of a batch.
+    '''
+
+    def __init__(self, score_fn, model_id='', max_batch=4096, batch_wait=0.0):
+        '''
+        Args:
+            score_fn: maps a list of sequences to an array with one row per sequence
+            model_id: identifier of the model for the prediction cache, e.g. EnsembleEvaluator.model_id
+            max_batch: number of sequences after which no more requests are added to a batch
+            batch_wait: seconds to wait for more requests before scoring a batch
+        '''
+        self.score_fn = score_fn
+        self.model_id = model_id
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def predict(self, seqs):
+        request = _Request(list(seqs))
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        size = len(batch[0].seqs)
+        while size < self.max_batch:
+            try:
+                request = self.requests.get(timeout=self.batch_wait) if self.batch_wait > 0 else self.requests.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.seqs)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            seqs = [seq for request in batch for seq in request.seqs]
+            try:
+                with METRICS.timer('server_batch', len(seqs)):
+                    results = np.asarray(self.score_fn(seqs))
+                METRICS.increment('server_requests', len(batch))
+                start = 0
+                for request in batch:
+                    request.result = results[start:start + len(request.seqs)]
+                    start += len(request.seqs)
+            except Exception as exc:
+                for request in batch:
+                    request.error = exc
+            for request in batch:
+                request.done.set()
+
+
+class _RequestHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        models = self.server.models
+        while True:
+            try:
+                header, _ = recv_message(self.request)
+            except EOFError:
+                return
+            try:
+                if header['op'] == 'models':
+                    send_message(self.request, {'models': {name: {'model_id': model.model_id}
+                                                           for name, model in models.items()}})
+                elif header['op'] == 'predict':
+                    if header['model'] not in models:
+                        raise KeyError('model not served: ' + header['model'])
+                    send_message(self.request, {}, models[header['model']].predict(header['seqs']))
+                else:
+                    raise ValueError('unknown request: ' + header['op'])
+            except Exception as exc:
+                send_message(self.request, {'error': repr(exc)})
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Serves BatchingModels over a Unix socket, one thread per client connection. Clients send lists of
+    sequences and get back one row of predictions per sequence, e.g. the predictions of every
+    member of an ensemble.
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, models):
+        '''
+        Args:
+            path: socket file, replaced if it exists
+            models: dict from model name to BatchingModel
+        '''
+        if os.path.exists(path):
+            os.remove(path)
+        self.path = path
+        self.models = models
+        super().__init__(path, _RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class InferenceClient:
+    '''
+    Client of an InferenceServer. The connection is opened on the first request and reopened in
+    forked worker processes, so a client can be shared with a multiprocessing Pool.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._models = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def _request(self, header):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self._sock.connect(self.path)
+                self._pid = os.getpid()
+            send_message(self._sock, header)
+            response, array = recv_message(self._sock)
+        if 'error' in response:
+            raise RuntimeError('inference server: ' + response['error'])
+        return response, array
+
+    def models(self):
+        '''
+        Returns:
+            dict from served model name to {'model_id': ...}
+        '''
+        if self._models is None:
+            self._models = self._request({'op': 'models'})[0]['models']
+        return self._models
+
+    def predict(self, model, seqs):
+        '''
+        Score sequences with a served model
+        Args:
+            model: model name, e.g. 'cnn' for the CNN ensemble
+            seqs: list of sequences
+        Returns:
+            array with one row per sequence, e.g. (num_seqs, num_members) for an ensemble
+        '''
+        with METRICS.timer('server_predict', len(seqs)):
+            return self._request({'op': 'predict', 'model': model, 'seqs': list(seqs)})[1]
+
+    def ensemble(self, model):
+        return RemoteEnsemble(self, model)
+
+    def seq2fitness(self, model):
+        '''
+        Returns:
+            function with the call signature of seq2fitness_handler.seq2fitness, scored by the server
+        '''
+        def seq2fitness(seqs):
+            if isinstance(seqs, str):
+                return self.predict(model, [seqs])[0]
+            return self.predict(model, seqs)
+        return seq2fitness
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self._pid = None
+
+
+class RemoteEnsemble:
+    '''
+    Stand-in for EnsembleEvaluator that scores sequences on the inference server. The server encodes
+    the sequences itself, so predict_cached accepts encoded_data=None, and its model_id matches the
+    local EnsembleEvaluator so both share the prediction cache.
+    '''
+
+    def __init__(self, client, model):
+        self.client = client
+        self.model = model
+
+    @property
+    def model_id(self):
+        return self.client.models()[self.model]['model_id']
+
+    def predict_seqs(self, seqs):
+        return self.client.predict(self.model, seqs)
+
+    def predict_cached(self, seqs, encoded_data=None, cache=None):
+        if cache is None:
+            return self.predict_seqs(seqs)
+        return cache.predict(self.model_id, seqs, self.predict_seqs)
+
+    def close(self):
+        pass
+
+
+def open_inference_client(default_path):
+    '''
+    Connect to a running inference server
+    Args:
+        default_path: socket used when the INFERENCE_SERVER environment variable is not set
+    Returns:
+        InferenceClient, or None if no server is listening or INFERENCE_SERVER=none
+    '''
+    path = os.environ.get(SERVER_ENV_VAR, default_path)
+    if path.lower() == 'none' or not os.path.exists(path):
+        return None
+    client = InferenceClient(path)
+    try:
+        client.models()
+    except (OSError, EOFError):
+        # stale socket file of a server that is no longer running
+        return None
+    return client
@@ -0,0 +1,164 @@
+"""Concurrent SRA downloads and streaming of SRA runs into read merging and counting."""
+
+import os
+import shlex
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice, tee
+from os.path import exists, join
+
+from count_tools import count_read_pair_chunk, count_records
+from fastq_tools import iter_fastq_records, READ_BUFFER_SIZE
+from instrumentation import METRICS
+
+
+# command templates, formatted with the SRA run accession, the library name and the output directory.
+# The download command must write {name}_1.fastq and {name}_2.fastq to {outdir}, the stream command
+# must write interleaved R1/R2 records to stdout. Any command with the same behavior, e.g. a local
+# script emitting FASTQ, can be used instead of fasterq-dump
+DOWNLOAD_COMMAND = 'fasterq-dump {run} --outfile {name} --outdir {outdir}'
+STREAM_COMMAND = 'fasterq-dump {run} --split-spot --stdout'
+
+
+def format_command(template, **fields):
+    '''
+    Fill in a command template and split it into arguments, without going through a shell
+    '''
+    return shlex.split(template.format(**{key: shlex.quote(str(value)) for key, value in fields.items()}))
+
+
+def with_retries(fn, retries=3, backoff=30, desc=''):
+    '''
+    Call fn until it succeeds, waiting backoff, 2 * backoff, ... seconds between attempts
+    Args:
+        fn: function without arguments
+        retries: number of retries after the first attempt
+        backoff: seconds to wait before the first retry
+        desc: name used in messages
+    Returns:
+        the result of fn
+    '''
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except (OSError, subprocess.CalledProcessError, RuntimeError) as exc:
+            if attempt == retries:
+                raise
+            print(f'{desc} failed ({exc}), retrying in {backoff * 2 ** attempt} s')
+            time.sleep(backoff * 2 ** attempt)
+
+
+def download_run(run, name, outdir='.', command=DOWNLOAD_COMMAND, retries=3, backoff=30):
+    '''
+    Download the R1/R2 FASTQ files of an SRA run, skipped if they are already on disk
+    Args:
+        run: SRA run accession, e.g. SRR29266169
+        name: library name, the files are saved as {name}_R1.fastq and {name}_R2.fastq
+        outdir: output directory
+        command: download command template, see DOWNLOAD_COMMAND
+        retries: number of retries of a failed download
+        backoff: seconds to wait before the first retry
+    Returns:
+        paths to the R1 and R2 files
+    '''
+    file_base = join(outdir, name)
+    paths = [f'{file_base}_R{r}.fastq' for r in [1, 2]]
+    if all(exists(path) for path in paths):
+        return paths
+
+    def download():
+        with METRICS.timer('sra_download'):
+            subprocess.run(format_command(command, run=run, name=name, outdir=outdir), check=True)
+        # rename output file to use R1 and R2 to indicate read direction
+        for r, path in zip([1, 2], paths):
+            os.replace(f'{file_base}_{r}.fastq', path)
+        return paths
+    return with_retries(download, retries, backoff, desc=run)
+
+
+def fetch_runs(runs, outdir='.', command=DOWNLOAD_COMMAND, workers=4, retries=3, backoff=30):
+    '''
+    Download SRA runs with a bounded number of concurrent downloads
+    Args:
+        runs: list of (run accession, library name)
+        outdir: output directory
+        command: download command template, see DOWNLOAD_COMMAND
+        workers: maximum number of downloads running at the same time
+        retries: number of retries of a failed download
+        backoff: seconds to wait before the first retry
+    Returns:
+        generator of (run, name, R1 path, R2 path) in the order the downloads finish. Runs that still fail
+        after all retries are reported with a RuntimeError once the other downloads are done
+    '''
+    failed = []
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = {executor.submit(download_run, run, name, outdir, command, retries, backoff): (run, name)
+               for run, name in runs}
+    try:
+        for future in as_completed(futures):
+            run, name = futures[future]
+            try:
+                r1_path, r2_path = future.result()
+            except Exception as exc:
+                print(f'{run} could not be downloaded: {exc}')
+                failed.append(run)
+                continue
+            yield run, name, r1_path, r2_path
+    finally:
+        # if the consumer stops early, e.g. on a counting error, queued downloads are dropped instead of
+        # waited for (cancel_futures of Python 3.9+ by hand), only the running ones are left to finish
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+    if failed:
+        raise RuntimeError('failed to download ' + ', '.join(failed))
+
+
+def split_interleaved(records):
+    '''
+    Split interleaved R1/R2 records (R1 and R2 of each spot one after the other) into two record streams.
+    Only a few records are buffered when both streams are read in step, as iter_read_pair_batches does
+    Returns:
+        fwd_records, rev_records
+    '''
+    fwd, rev = tee(records)
+    return islice(fwd, 0, None, 2), islice(rev, 1, None, 2)
+
+
+def count_streamed_run(task):
+    '''
+    Merge and count the read pairs of an SRA run straight from the stream command's stdout, nothing is
+    written to disk except the optional merged reads. A failed stream is counted again from the start
+    Args:
+        task: dict with the keys of count_read_pair_chunk except the file keys, plus
+            run: SRA run accession
+            stream_command: stream command template, see STREAM_COMMAND
+            retries, backoff: retries of a failed stream and seconds to wait before the first one
+    Returns:
+        counts, stats and metrics, as count_read_pair_chunk
+    '''
+    def count_stream():
+        proc = subprocess.Popen(format_command(task['stream_command'], run=task['run']), stdout=subprocess.PIPE,
+                                bufsize=READ_BUFFER_SIZE)
+        try:
+            fwd_records, rev_records = split_interleaved(iter_fastq_records(proc.stdout))
+            with METRICS.timer('sra_stream'):
+                counts, stats = count_records(task, fwd_records, rev_records)
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise RuntimeError(f'stream command exited with status {returncode}')
+        return counts, stats
+    counts, stats = with_retries(count_stream, task['retries'], task['backoff'], desc=task['run'])
+    return counts, stats, METRICS.snapshot()
+
+
+def count_task(task):
+    '''
+    Count a preprocessing task, a chunk of a FASTQ file pair or a streamed SRA run
+    '''
+    if 'stream_command' in task:
+        return count_streamed_run(task)
+    return count_read_pair_chunk(task)